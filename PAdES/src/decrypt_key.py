@@ -1,56 +1,372 @@
 """!
 @file decrypt_key.py
 @brief Contains the function to decrypt an RSA private key stored on a USB device.
+
+@details Two key file formats are supported:
+- legacy (no header): salt (16 bytes) + nonce (16 bytes) + tag (16 bytes) + ciphertext, PBKDF2-HMAC-SHA1 and AES-EAX
+- version 2: "PKEY" + 0x02 + salt (16 bytes) + nonce (12 bytes) + tag (16 bytes) + ciphertext, PBKDF2-HMAC-SHA256 and AES-GCM
+- version 3: "PKEY" + 0x03 + iterations (4 bytes, big endian) + salt (16 bytes) + nonce (12 bytes) + tag (16 bytes) + ciphertext,
+  as version 2 but with the PBKDF2 iteration count calibrated by the RSA application stored in the header
+- version 4: "PKEY" + 0x04 + log2(N), r, p (1 byte each) + salt (16 bytes) + nonce (12 bytes) + tag (16 bytes) + ciphertext,
+  scrypt and AES-GCM
+
+Legacy files are rewritten in the version 4 format after the first successful decryption (version 3 if hashlib has no scrypt).
+
+The key derivation relies on a native PBKDF2: the optional 'fastpbkdf2' package or OpenSSL through hashlib. OpenSSL chooses
+the SHA-NI (x86) or SHA2 (ARMv8) instructions at runtime when the CPU has them, so no build flags are needed. A Python built
+without OpenSSL falls back to a pure-Python PBKDF2 that is far too slow for 600,000 iterations, a warning is shown in that case.
 """
 
-from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Cipher import AES
+import atexit
+import ctypes
+import hashlib
+import mmap
 import os
+import threading
+import warnings
+from pathlib import Path
+
+try:
+    from fastpbkdf2 import pbkdf2_hmac
+except ImportError:
+    from hashlib import pbkdf2_hmac
+
+if pbkdf2_hmac.__module__ not in ("_hashlib", "fastpbkdf2"):
+    warnings.warn("PBKDF2 is not backed by OpenSSL, decrypting the private key will be very slow", RuntimeWarning)
+
+## Magic bytes starting every versioned key file. Legacy files start directly with the random salt.
+KEY_FILE_MAGIC = b"PKEY"
+## Format version written by _upgrade_key_file().
+KEY_FILE_VERSION = 4
+## Number of PBKDF2 iterations of legacy and version 2 files, also used when a legacy file is upgraded.
+KDF_ITERATIONS = 600000
+## Highest iteration count accepted from a version 3 header, so a damaged file cannot hang the application.
+MAX_KDF_ITERATIONS = 20000000
+## Highest scrypt memory use (128 * r * (N + p) bytes) accepted from a version 4 header, 1 GiB.
+MAX_SCRYPT_MEMORY = 1024 * 1024 * 1024
+## scrypt cost parameters written by _upgrade_key_file(), the same as key_encryption.py in the RSA application: N = 2**17, r = 8, p = 1.
+SCRYPT_LOG2_N = 17
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+## AES keys derived in this session as bytearrays, keyed by the format version, SHA256(PIN + salt) and the key derivation parameters.
+## Filled only after a successful decryption. Guarded by _KEY_CACHE_LOCK, the expiry timers remove keys from another thread.
+## Wiping is best effort and covers these cache entries only: the bytes returned by the KDF, the copies returned by _cached_key()
+## and the key schedule inside the AES object are immutable or out of reach and stay in memory until Python frees them.
+_KEY_CACHE = {}
+_KEY_CACHE_LOCK = threading.Lock()
+## Maximum number of keys kept in _KEY_CACHE, the oldest one is dropped first.
+_KEY_CACHE_SIZE = 8
+## How long a derived key stays in _KEY_CACHE after it was derived, in seconds. Also used by sign_pdf.py for the imported private keys.
+KEY_CACHE_TTL = 120.0
+
+try:
+    # mlock()/munlock() from the C library, used to keep cached keys out of swap; None where they are not available (e.g. Windows)
+    _libc = ctypes.CDLL(None, use_errno=True) if os.name == "posix" else None
+    _libc.mlock, _libc.munlock
+except (OSError, AttributeError):
+    _libc = None
+## Number of cached keys on every memory page locked by _lock_memory(), keyed by the page number. Guarded by _KEY_CACHE_LOCK.
+## mlock() and munlock() work on whole pages, a page is unlocked only when the last key on it leaves the cache.
+_locked_pages = {}
+
+def _derive_key(pin_bytes, salt, kdf):
+    """!
+    @brief Derives the 256-bit AES key from the PIN with PBKDF2-HMAC or scrypt.
+
+    @details For PBKDF2, if the optional 'fastpbkdf2' package is installed, its C implementation is used. It computes the HMAC inner and outer
+    states once per PIN instead of once per iteration, which makes the derivation about twice as fast. Otherwise hashlib.pbkdf2_hmac() is used,
+    which runs the whole loop in OpenSSL and releases the GIL. Both give the same key.
+    scrypt always runs in OpenSSL through hashlib.scrypt().
+
+    @param pin_bytes (bytes): The encoded PIN used to derive the key.
+    @param salt (bytes): The 128-bit salt stored in the encrypted file.
+    @param kdf (tuple): ("pbkdf2", hash_name, iterations), hash_name being "sha1" for legacy files and "sha256" for version 2 and 3 files,
+    or ("scrypt", log2_n, r, p) for version 4 files, as returned by _parse_key_file().
+
+    @return bytes: The 32-byte AES key.
+    """
+    if kdf[0] == "scrypt":
+        _, log2_n, r, p = kdf
+        return hashlib.scrypt(pin_bytes, salt=salt, n=2 ** log2_n, r=r, p=p, maxmem=128 * r * (2 ** log2_n + p + 2) + 1024 * 1024, dklen=32)
+    _, hash_name, iterations = kdf
+    return pbkdf2_hmac(hash_name, pin_bytes, salt, iterations, 32)
+
+def _parse_key_file(data, pin):
+    """!
+    @brief Splits the content of an encrypted key file into its fields.
+
+    @param data (bytes): The content of the encrypted key file.
+    @param pin (str): The PIN entered by the user.
+
+    @return tuple: (version, pin_bytes, kdf, salt, nonce, tag, ciphertext, aes_mode), where version is 1 for legacy files and kdf
+    describes the key derivation as expected by _derive_key().
+
+    @throws ValueError If the file is too short or its header holds invalid key derivation parameters.
+    """
+    magic_size = len(KEY_FILE_MAGIC)
+    if data[:magic_size] == KEY_FILE_MAGIC and data[magic_size:magic_size + 1] in (b"\x02", b"\x03", b"\x04"):
+        version = data[magic_size]
+        body = data[magic_size + 1:]
+        if len(body) < {2: 0, 3: 4, 4: 3}[version] + 44: # KDF parameters + salt, nonce and tag
+            raise ValueError("Key file is too short")
+        kdf = ("pbkdf2", "sha256", KDF_ITERATIONS)
+        if version == 3:
+            iterations = int.from_bytes(body[:4], "big")
+            body = body[4:]
+            if not 0 < iterations <= MAX_KDF_ITERATIONS:
+                raise ValueError(f"Invalid iteration count in key file: {iterations}")
+            kdf = ("pbkdf2", "sha256", iterations)
+        elif version == 4:
+            log2_n, r, p = body[0], body[1], body[2]
+            body = body[3:]
+            if not (0 < log2_n and 0 < r and 0 < p and 128 * r * (2 ** log2_n + p) <= MAX_SCRYPT_MEMORY):
+                raise ValueError(f"Invalid scrypt parameters in key file: N=2**{log2_n}, r={r}, p={p}")
+            kdf = ("scrypt", log2_n, r, p)
+        return version, pin.encode("utf-8"), kdf, body[:16], body[16:28], body[28:44], body[44:], AES.MODE_GCM
+    if len(data) < 48:
+        raise ValueError("Key file is too short")
+    # legacy files were written with pycryptodome's PBKDF2 defaults: HMAC-SHA1 and a latin-1 encoded PIN
+    return 1, pin.encode("latin-1"), ("pbkdf2", "sha1", KDF_ITERATIONS), data[:16], data[16:32], data[32:48], data[48:], AES.MODE_EAX
+
+def _write_synced(path, data, mode=0o644):
+    """!
+    @brief Writes a key file with unbuffered writes and flushes it to the device.
+
+    @details The file is opened with os.open(), so the data goes from the bytes object straight to the kernel without Python's buffer in between,
+    and is written with a single os.write() call for a key of this size, larger Python buffers would not change the number of writes.
+    os.fsync() then flushes it to the device once, so the key is on the USB drive before the old one is replaced, even if the drive is pulled out right after.
+    O_DIRECT is not used, it needs page aligned buffers, is not supported by every file system used on USB drives and does not exist on Windows.
+
+    @param path (str): The path of the key file.
+    @param data (bytes): The content of the file.
+    @param mode (int): The permissions of a newly created file, where the platform supports them.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), mode)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _sync_directory(path):
+    """!
+    @brief Flushes a directory entry change, such as a rename, to the device.
+
+    @details Directories cannot be opened on Windows, where a rename is committed by the file system itself, so the error is ignored there.
+
+    @param path (str): The path of the directory.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _upgrade_key_file(enc_file, private_key, pin):
+    """!
+    @brief Re-encrypts a decrypted private key in the version 4 format and replaces the key file with it.
+
+    @details A new salt and nonce are generated, the key is derived with scrypt (N = 2**17, r = 8, p = 1) and the private key is encrypted with AES-GCM.
+    If hashlib has no scrypt, the version 3 format with PBKDF2-HMAC-SHA256 is written instead.
+    The new content is written to a temporary file next to the old one and flushed to the device with _write_synced(), which is then replaced
+    in a single rename, and the rename is flushed with _sync_directory(). On FAT and exFAT the rename could otherwise reach the drive before the data,
+    and a drive pulled out right after signing would be left with an empty key file. If writing fails, the temporary file is removed and the old key file stays as it was.
+
+    @param enc_file (str): The path to the encrypted key file to replace.
+    @param private_key (bytes): The decrypted private key.
+    @param pin (str): The PIN the private key was decrypted with.
 
-def decrypt_private_key(usb_path, pin, progress_callback):
+    @return tuple[int, tuple, bytes, bytes]: The version and kdf of the new file, the new salt and the AES key derived from it.
+    """
+    if hasattr(hashlib, "scrypt"):
+        version, kdf = KEY_FILE_VERSION, ("scrypt", SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P)
+        header = KEY_FILE_MAGIC + bytes([KEY_FILE_VERSION, SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P])
+    else:
+        version, kdf = 3, ("pbkdf2", "sha256", KDF_ITERATIONS)
+        header = KEY_FILE_MAGIC + bytes([3]) + KDF_ITERATIONS.to_bytes(4, "big")
+    salt = os.urandom(16)
+    key = _derive_key(pin.encode("utf-8"), salt, kdf)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=os.urandom(12))
+    ciphertext, tag = cipher.encrypt_and_digest(private_key)
+
+    tmp_file = enc_file + ".tmp"
+    try:
+        _write_synced(tmp_file, b"".join((header, salt, cipher.nonce, tag, ciphertext)), 0o600)
+        os.replace(tmp_file, enc_file) # the new key is complete on the drive before the old one is replaced
+    except OSError:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+    _sync_directory(os.path.dirname(enc_file))
+    return version, kdf, salt, key
+
+def _lock_memory(buffer, lock):
+    """!
+    @brief Locks the pages of a buffer in RAM with mlock(), or releases them, so a cached key is not written to swap.
+
+    @details Pages are counted in _locked_pages: a page is locked when the first cached key on it is added and unlocked with munlock() only
+    when the last one is removed, so expiring one key never unlocks another key sharing its page.
+    Best effort: nothing happens where the C functions are missing, and a failure (e.g. the RLIMIT_MEMLOCK limit) is ignored.
+    Must be called with _KEY_CACHE_LOCK held.
+
+    @param buffer (bytearray): The buffer holding a key.
+    @param lock (bool): True to lock the buffer, False to release it.
+    """
+    if _libc is None or not buffer:
+        return
+    address = ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer))
+    for page in range(address // mmap.PAGESIZE, (address + len(buffer) - 1) // mmap.PAGESIZE + 1):
+        count = _locked_pages.get(page, 0) + (1 if lock else -1)
+        if lock and count == 1:
+            _libc.mlock(ctypes.c_void_p(page * mmap.PAGESIZE), ctypes.c_size_t(mmap.PAGESIZE))
+        elif not lock and count == 0:
+            _libc.munlock(ctypes.c_void_p(page * mmap.PAGESIZE), ctypes.c_size_t(mmap.PAGESIZE))
+        if count > 0:
+            _locked_pages[page] = count
+        else:
+            _locked_pages.pop(page, None)
+
+def _wipe_key(buffer):
+    """!
+    @brief Overwrites a cached key with zeros and releases its memory pages with _lock_memory().
+
+    @details Only the cache entry is wiped, other copies of the key are not reachable from here (see _KEY_CACHE).
+
+    @param buffer (bytearray): The buffer holding the key.
+    """
+    buffer[:] = bytes(len(buffer))
+    _lock_memory(buffer, False)
+
+def _clear_key_cache():
+    """!
+    @brief Wipes all keys in _KEY_CACHE and empties it. Registered with atexit.
+    """
+    with _KEY_CACHE_LOCK:
+        for buffer in _KEY_CACHE.values():
+            _wipe_key(buffer)
+        _KEY_CACHE.clear()
+
+atexit.register(_clear_key_cache)
+
+def _expire_key(key_cache_key, buffer):
+    """!
+    @brief Removes a key from _KEY_CACHE and wipes it. Runs on the timer started by _cache_key() once KEY_CACHE_TTL has passed.
+
+    @details The key is removed only if the entry still holds the same buffer, an entry evicted earlier was already wiped.
+
+    @param key_cache_key (tuple): The cache key built in decrypt_private_key().
+    @param buffer (bytearray): The buffer stored by _cache_key().
+    """
+    with _KEY_CACHE_LOCK:
+        if _KEY_CACHE.get(key_cache_key) is buffer:
+            del _KEY_CACHE[key_cache_key]
+            _wipe_key(buffer)
+
+def _cached_key(key_cache_key):
+    """!
+    @brief Returns a copy of a key from _KEY_CACHE.
+
+    @details A copy is returned, so the expiry timer can wipe the cached buffer while the caller is still using the key.
+
+    @param key_cache_key (tuple): The cache key built in decrypt_private_key().
+
+    @return bytes | None: The cached AES key, or None if it is not cached or has expired.
+    """
+    with _KEY_CACHE_LOCK:
+        buffer = _KEY_CACHE.get(key_cache_key)
+        return bytes(buffer) if buffer is not None else None
+
+def _cache_key(key_cache_key, key):
+    """!
+    @brief Stores a derived AES key in _KEY_CACHE for KEY_CACHE_TTL seconds, dropping and wiping the oldest entry when the cache is full.
+
+    @details The key is copied into a bytearray locked in RAM with _lock_memory(), so the cache entry can be overwritten with zeros when it leaves the cache.
+    The key passed in is not wiped, it is an immutable bytes object from the KDF.
+    A daemon timer calls _expire_key() after KEY_CACHE_TTL seconds, so the key is wiped on time even if the signing worker process stays idle.
+
+    @param key_cache_key (tuple): The cache key built in decrypt_private_key().
+    @param key (bytes | bytearray): The derived AES key.
+    """
+    with _KEY_CACHE_LOCK:
+        if key_cache_key in _KEY_CACHE:
+            return
+        if len(_KEY_CACHE) >= _KEY_CACHE_SIZE:
+            _wipe_key(_KEY_CACHE.pop(next(iter(_KEY_CACHE))))
+        buffer = bytearray(key)
+        _lock_memory(buffer, True)
+        _KEY_CACHE[key_cache_key] = buffer
+    timer = threading.Timer(KEY_CACHE_TTL, _expire_key, (key_cache_key, buffer))
+    timer.daemon = True # a pending expiry does not keep the process alive, atexit wipes the keys instead
+    timer.start()
+
+def decrypt_private_key(usb_path, pin, progress_callback=None):
     """!
     @brief Decrypts an RSA private key stored on a USB device using AES and a PIN-based key derivation.
 
     @details This function looks for an encrypted private key file inside the "keys" folder on the specified in params USB path.  
-    It reads the encrypted data and derives the AES key from the user-provided PIN using PBKDF2 with a 128-bit salt and 600,000 iterations.  
-    Decryption is done using AES in EAX mode. Progress updates are reported with the callback function.
+    It reads the encrypted data and derives the AES key from the user-provided PIN using PBKDF2 with a 128-bit salt and 600,000 iterations, or the count stored in a version 3 header.  
+    Version 4 files use scrypt with the parameters stored in the header instead of PBKDF2.  
+    The whole derivation is a single PBKDF2 or scrypt call done by _derive_key(), so it runs entirely in native code.  
+    After a successful decryption the derived key is kept in memory for KEY_CACHE_TTL seconds and then its cache entry is wiped (best effort, see _KEY_CACHE), so signing more documents with the same PIN and key file skips the derivation.  
+    Version 2, 3 and 4 files are decrypted with AES in GCM mode, legacy files with AES in EAX mode. A legacy file is upgraded to version 4 with _upgrade_key_file()  
+    once it was decrypted, a failed upgrade is only reported and the legacy file stays usable.  
+    Progress updates are reported with the callback function before and after the key derivation.
 
     The function uses the following libraries:
-    - 'pycryptodome' – Crypto.Protocol.KDF.PBKDF2, Crypto.Cipher.AES
-    - 'os' – to search for the encrypted file on the USB drive
+    - 'pycryptodome' – Crypto.Cipher.AES
+    - 'hashlib' – scrypt and PBKDF2 key derivation, or 'fastpbkdf2' (optional) for PBKDF2 when installed
+    - 'pathlib' – to search for the encrypted file on the USB drive
 
     @param usb_path (str): The path to the USB device where the encrypted private key is stored.
     @param pin (str): The PIN used to derive the decryption key.
-    @param progress_callback Callable[[str], None]: A callback function to show decryption progress.
+    @param progress_callback Callable[[str], None] | None: An optional callback function to show decryption progress.
 
     @return bytes | None: The decrypted private key (in bytes) if successful, or None if an error occurs or the key file is missing.
     """
+    if progress_callback is None:
+        progress_callback = lambda message: None
+
     try:
-        enc_file = None
-        for root, dirs, files in os.walk(os.path.join(usb_path, "keys")):
-            for f in files:
-                if f.endswith("_private_key.enc"):
-                    enc_file = os.path.join(root, f)
-                    break
+        # glob() is lazy, so the search stops at the first key file instead of walking the whole folder tree
+        key_files = Path(usb_path, "keys").glob("**/*_private_key.enc")
+        enc_file = next((str(path) for path in key_files if path.is_file()), None)
         if enc_file is None:
             return None
 
+        # a key file is a few KB, reading it at once is cheaper than mapping it, and the file is closed before a legacy file is replaced
         with open(enc_file, "rb") as f:
             data = f.read()
+        version, pin_bytes, kdf, salt, nonce, tag, ciphertext, aes_mode = _parse_key_file(data, pin)
+        key_cache_key = (version, hashlib.sha256(pin.encode("utf-8") + salt).digest(), kdf)
+        key = _cached_key(key_cache_key)
+        if key is None:
+            progress_callback("Deriving key...")
+            key = _derive_key(pin_bytes, salt, kdf)
 
-        salt = data[:16]
-        nonce = data[16:32]
-        tag = data[32:48]
-        ciphertext = data[48:]
-
-        key = None
-        iterations = 600000
-        
-        key = PBKDF2(pin, salt, dkLen=32, count=iterations)
-        
-        progress_callback("Decrypting...")  
-        cipher = AES.new(key, AES.MODE_EAX, nonce=nonce)
+        progress_callback("Decrypting...")
+        cipher = AES.new(key, aes_mode, nonce=nonce)
         private_key = cipher.decrypt_and_verify(ciphertext, tag)
+
+        if version == 1: # newer files already use SHA256 and AES-GCM, rewriting them would only cost another derivation
+            progress_callback("Upgrading key file...")
+            try:
+                version, kdf, salt, key = _upgrade_key_file(enc_file, private_key, pin)
+                key_cache_key = (version, hashlib.sha256(pin.encode("utf-8") + salt).digest(), kdf)
+            except Exception as e:
+                print(f"[decrypt_private_key] Key file upgrade failed: {e}")
+
+        _cache_key(key_cache_key, key)
         return private_key
 
     except Exception as e:
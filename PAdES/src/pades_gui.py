@@ -12,17 +12,18 @@ Used libraries:
 - 'pypdf' for PDF manipulation
 - 'pycryptodome' for cryptographic operations
 - 'os' for file handling
-- 'threading' for threads working in the background
-Functions from other modules like sign_pdf(), decrypt_private_key(), and verify_pdf_signature() are used for signing, decrypting, and verifying operations.
+- 'concurrent.futures' and 'multiprocessing' for the worker process doing the signing in the background
+Functions from other modules like sign_pdf_with_usb_key() and verify_pdf_signature() are used for decrypting, signing, and verifying operations.
 """
 
-from tkinter import Tk, Label, Entry, Button, messagebox, IntVar, ttk, Radiobutton, StringVar
+from tkinter import Tk, Label, Entry, Button, messagebox, ttk, Radiobutton, StringVar
 from tkinter.ttk import Progressbar
-from sign_pdf import sign_pdf
-from decrypt_key import decrypt_private_key
+from sign_pdf import sign_pdf_with_usb_key
 from pades_utils import browse_pdf_file, update_usb_devices, browse_public_key_file
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import os
-import threading
 from verify_signature import verify_pdf_signature
 
 def update_mode():
@@ -53,71 +54,126 @@ def update_mode():
         public_key_entry.grid()
         public_key_browse.grid()
 
-def sign_document():
+## Single worker process running sign_pdf_with_usb_key(), created on the first signing.
+_sign_pool = None
+
+def get_sign_pool():
     """!
-    @brief Handles the process of signing a selected PDF file.
+    @brief Returns the worker process pool used for signing, creating it on first use.
+
+    @details Key derivation, decryption and signing run in a separate process, so they never compete with Tk for the GIL.
+    The pool keeps one worker alive for the whole session, so the caches of derived and imported keys in that worker
+    are reused by later signings. The worker is started with "spawn", forking a process that runs Tk is not safe.
+    A pool whose worker died is dropped with reset_sign_pool(), so the next call starts a new one.
 
-    @details This function retrieves the PIN, PDF file path, and USB device path from the GUI entries.
-    It validates the paths, decrypts the private key using the provided PIN, and then signs the PDF file with that key.
-    If any step fails, it shows an error with proper message. If the signing is successful, it updates the GUI to inform the user.
-    decrypt_private_key() function is used to decrypt the private key, and sign_pdf() function is used to sign the PDF file.
+    @return concurrent.futures.ProcessPoolExecutor: The pool with a single worker process.
     """
-    pin = pin_entry.get()
-    pdf_path = pdf_path_entry.get()
-    usb_path = usb_path_entry.get()
+    global _sign_pool
+    if _sign_pool is None:
+        _sign_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return _sign_pool
 
-    if not os.path.isfile(pdf_path):
-        messagebox.showerror("Error", "Invalid PDF file path")
-        return
-    if not os.path.exists(usb_path):
-        messagebox.showerror("Error", "Invalid USB path")
-        return
+def reset_sign_pool():
+    """!
+    @brief Drops a broken worker process pool, get_sign_pool() creates a new one on its next call.
 
-    progress_label.config(text="Decrypting key...")
-    progress_label.update_idletasks()
+    @details A ProcessPoolExecutor whose worker died (killed, out of memory, crashed in native code) rejects every later task with BrokenProcessPool.
+    """
+    global _sign_pool
+    if _sign_pool is not None:
+        _sign_pool.shutdown(wait=False, cancel_futures=True)
+        _sign_pool = None
+
+def submit_signing(pdf_path, usb_path, pin):
+    """!
+    @brief Submits sign_pdf_with_usb_key() to the worker process, replacing the pool once if it is broken.
 
-    def progress_callback(message):
-        progress_label.config(text=message)
-        progress_label.update_idletasks()
+    @param pdf_path (str): The path to the PDF file to sign.
+    @param usb_path (str): The path to the USB device with the encrypted private key.
+    @param pin (str): The PIN for the private key.
+
+    @return concurrent.futures.Future: The future of the signing.
+    """
+    try:
+        return get_sign_pool().submit(sign_pdf_with_usb_key, pdf_path, usb_path, pin)
+    except BrokenProcessPool:
+        reset_sign_pool()
+        return get_sign_pool().submit(sign_pdf_with_usb_key, pdf_path, usb_path, pin)
+
+def poll_signing(future):
+    """!
+    @brief Checks every 50 ms whether the signing in the worker process has finished, then calls finish_signing().
 
-    private_key = decrypt_private_key(usb_path, pin, progress_callback)
-    if private_key is None:
-        messagebox.showerror("Error", "Failed to decrypt private key")
+    @param future (concurrent.futures.Future): The future returned when sign_pdf_with_usb_key() was submitted.
+    """
+    if not future.done():
+        root.after(50, poll_signing, future)
         return
+    try:
+        success, message = future.result()
+    except BrokenProcessPool:
+        reset_sign_pool() # the worker died, the next signing starts a new one
+        success, message = False, "Error: the signing process stopped unexpectedly"
+    except Exception as e:
+        success, message = False, f"Error: {e}"
+    finish_signing(success, message)
+
+def finish_signing(success, message):
+    """!
+    @brief Restores the GUI after signing and shows the result. Called by poll_signing() once the worker process is done.
 
-    progress_label.config(text="Signing PDF...")
-    success = sign_pdf(pdf_path, private_key)
+    @param success (bool): Whether the PDF was signed.
+    @param message (str): The message returned by sign_pdf_with_usb_key().
+    """
+    progress_label.config(text="")
+    root.config(cursor="")
+    progress_label.grid_remove()
+    progress_bar.stop()
+    progress_bar.grid_remove()
+    pin_entry.config(state="normal")
+    pdf_path_entry.config(state="normal")
+    usb_path_entry.config(state="readonly")
+    sign_button.config(state="normal")
+    refresh_button.config(state="normal")
+    browse_button.config(state="normal")
 
     if success:
-        progress_label.config(text="PDF signed successfully!")
-        messagebox.showinfo("Success", "PDF has been signed successfully.")
+        messagebox.showinfo("Success", message)
     else:
-        messagebox.showerror("Error", "Failed to sign the PDF")
+        messagebox.showerror("Error", message)
 
 def handle_sign_button_click():
     """! 
     @brief Function handles the sign button click event in the GUI.
 
-    @details Disables GUI inputs, shows a progress messages and loading indicator, and launches the signing process in a new thread.
-    When the process is complete, it restores the GUI to its original state, enabling inputs and hiding the progress messages.
-    sign_document() function is called to perform the signing operation.
+    @details Retrieves the PIN, PDF file path, and USB device path from the GUI entries and validates the paths.
+    Submits the signing to the worker process with submit_signing(), then disables GUI inputs and shows a progress messages and loading indicator.
+    If the signing cannot be submitted, the error is shown and the GUI stays usable.
+    poll_signing() waits for the result without blocking the main loop and restores the GUI when the process is complete.
+    sign_pdf_with_usb_key() function is called to perform the decrypting and signing operations.
     """
-    def task():
-        sign_document()
-        progress_label.config(text="")
-        root.config(cursor="")
-        root.update()
-        progress_label.grid_remove()
-        pin_entry.config(state="normal")
-        pdf_path_entry.config(state="normal")
-        usb_path_entry.config(state="readonly")
-        sign_button.config(state="normal")
-        refresh_button.config(state="normal")
-        browse_button.config(state="normal")
-        progress_var.set(0)
+    pin = pin_entry.get()
+    pdf_path = pdf_path_entry.get()
+    usb_path = usb_path_entry.get()
+
+    if not os.path.isfile(pdf_path):
+        messagebox.showerror("Error", "Invalid PDF file path")
+        return
+    if not os.path.exists(usb_path):
+        messagebox.showerror("Error", "Invalid USB path")
+        return
+
+    try:
+        future = submit_signing(pdf_path, usb_path, pin)
+    except Exception as e:
+        messagebox.showerror("Error", f"Error: {e}")
+        return
 
     root.config(cursor="wait")
+    progress_label.config(text="Signing PDF...")
     progress_label.grid(row=8, column=0, columnspan=3, pady=5)
+    progress_bar.grid(row=9, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
+    progress_bar.start(10)
     root.update()
 
     pin_entry.config(state="disabled")
@@ -127,7 +183,7 @@ def handle_sign_button_click():
     refresh_button.config(state="disabled")
     browse_button.config(state="disabled")
 
-    threading.Thread(target=task).start()
+    root.after(50, poll_signing, future)
 
 def handle_verify_button_click():
     """! 
@@ -162,7 +218,7 @@ def main_pades():
     """
     global root, mode_var, pin_entry, usb_path_entry, sign_button, refresh_button, \
            verify_button, pin_label, usb_label, public_key_label, public_key_entry, \
-           public_key_browse, pdf_path_entry, browse_button, progress_label, progress_var
+           public_key_browse, pdf_path_entry, browse_button, progress_label, progress_bar
 
     root = Tk()
     root.title("PAdES PDF Signer")
@@ -199,10 +255,10 @@ def main_pades():
 
     root.grid_columnconfigure(1, weight=1)
 
-    progress_var = IntVar()
     progress_label = Label(root, text="Processing...")
+    progress_bar = Progressbar(root, mode="indeterminate") # the key derivation is one native call, there is no per-iteration progress to show
 
-    refresh_button = Button(root, text="Refresh USB Devices", command=lambda: update_usb_devices(usb_path_entry))
+    refresh_button = Button(root, text="Refresh USB Devices", command=lambda: update_usb_devices(usb_path_entry, refresh=True))
     refresh_button.grid(row=5, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
     sign_button = Button(root, text="Sign PDF", command=handle_sign_button_click)
     sign_button.grid(row=6, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
@@ -212,6 +268,9 @@ def main_pades():
     update_mode()
     root.mainloop()
 
+    if _sign_pool is not None:
+        _sign_pool.shutdown(cancel_futures=True)
+
 
 if __name__ == "__main__":
     main_pades()
@@ -10,13 +10,30 @@ This module provides helper functions to:
 
 Used libraries:
 - 'psutil' for detecting available USB devices
+- 'pyudev' (optional, Linux only) for noticing when block devices are added or removed
 - 'tkinter.filedialog' for file selection dialogs
 - 'os' for path handling and filesystem operations
+- 'time' for expiring the cached list of USB devices
 """
 
 import psutil
 from tkinter import filedialog
 import os
+import time
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+## How long get_usb_devices() reuses the last list of USB devices, in seconds.
+USB_CACHE_TTL = 2.0
+## Last list of USB devices and the time it was read, None when it has to be read again.
+_usb_cache = {"time": None, "devices": []}
+## pyudev observer thread invalidating _usb_cache, started on the first call to get_usb_devices().
+_usb_observer = None
+## File systems USB drives are formatted with, outside Windows other partitions are skipped before their mount options are parsed.
+USB_FSTYPES = frozenset({"vfat", "msdos", "exfat", "ntfs", "ntfs3", "fuseblk", "hfs", "apfs"})
 
 def browse_public_key_file(entry):
     """!
@@ -48,17 +65,57 @@ def browse_pdf_file(pdf_path_entry):
         pdf_path_entry.delete(0, 'end')
         pdf_path_entry.insert(0, file_path)
         
-def get_usb_devices():
+def invalidate_usb_cache(*args):
+    """!
+    @brief Forces the next call to get_usb_devices() to read the list of disks again.
+
+    @param args: Ignored, so the function can be used directly as a pyudev callback.
+    """
+    _usb_cache["time"] = None
+
+def _start_usb_observer():
+    """!
+    @brief Starts a pyudev observer that calls invalidate_usb_cache() whenever a block device is added or removed.
+
+    @details Does nothing if pyudev is not installed (for example on Windows) or the observer is already running.
+    In that case the cached list simply expires after USB_CACHE_TTL seconds.
+    """
+    global _usb_observer
+    if pyudev is None or _usb_observer is not None:
+        return
+    try:
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by(subsystem="block")
+        _usb_observer = pyudev.MonitorObserver(monitor, callback=invalidate_usb_cache, name="usb-observer")
+        _usb_observer.start()
+    except Exception as e:
+        print(f"[get_usb_devices] USB monitor unavailable: {e}")
+        _usb_observer = False
+
+def get_usb_devices(refresh=False):
     """!
     @brief Detects currently mounted removable USB storage devices.
 
     @details This function uses the `psutil` library to list all disks and filters them to find those that are removable (so the USB devices).
+    Listing the disks is slow on some systems (on Windows every drive letter is queried), so the result is reused for USB_CACHE_TTL seconds.
+    On Linux with pyudev installed the cached list is also dropped as soon as a block device is added or removed.
+
+    @param refresh (bool): If True, the cached list is ignored and the disks are listed again.
 
     @return list[str]: A list of connected device paths.
     """
-    partitions = psutil.disk_partitions()
-    usb_devices = [p.device for p in partitions if 'removable' in p.opts]
-    return usb_devices
+    now = time.monotonic()
+    if not refresh and _usb_cache["time"] is not None and now - _usb_cache["time"] < USB_CACHE_TTL:
+        return list(_usb_cache["devices"])
+
+    _start_usb_observer()
+    partitions = psutil.disk_partitions(all=False) # physical devices only, network shares and pseudo file systems are skipped
+    usb_devices = [p.device for p in partitions
+                   if (psutil.WINDOWS or p.fstype.lower() in USB_FSTYPES) # cheap pre-filter, on Windows the removable option alone decides
+                   and 'removable' in p.opts.split(',')] # a whole option, not a substring of one
+    _usb_cache["devices"] = usb_devices
+    _usb_cache["time"] = now
+    return list(usb_devices)
 
 def find_usb_with_key(usb_devices):
     """!
@@ -71,12 +128,12 @@ def find_usb_with_key(usb_devices):
     for device in usb_devices:
         key_dir = os.path.join(device, "keys")
         if os.path.isdir(key_dir):
-            for f in os.listdir(key_dir):
-                if f.endswith("_private_key.enc"):
+            with os.scandir(key_dir) as entries:
+                if any(e.is_file() and e.name.endswith("_private_key.enc") for e in entries):
                     return device
     return None
 
-def update_usb_devices(usb_path_entry):
+def update_usb_devices(usb_path_entry, refresh=False):
     """! 
     @brief Allows to update the list of USB devices currently connected to the computer. It auto-selects one containing a private key.
 
@@ -86,8 +143,9 @@ def update_usb_devices(usb_path_entry):
     a device with a private key.
 
     @param usb_path_entry: Tkinter library Combobox widget to update and populate with USB devices.
+    @param refresh (bool): If True, the cached list of USB devices is ignored, used by the "Refresh USB Devices" button.
     """
-    usb_devices = get_usb_devices()
+    usb_devices = get_usb_devices(refresh)
     usb_path_entry['values'] = usb_devices
     auto_device = find_usb_with_key(usb_devices)
     if auto_device:
@@ -0,0 +1,198 @@
+"""!
+@file pdf_digest.py
+@brief Contains the function computing the digest of the PDF content that gets signed.
+
+@details The digest is computed from the decoded page content streams, so pypdf does not have to rebuild the text layout
+of every page only to hash it. The content streams only draw what the page resources define, so everything reachable from the
+page "/Resources" (form XObjects, images, fonts, graphics states...) and the page boxes and rotation are hashed as well.
+Each page is hashed separately on a thread pool and the page digests are hashed once more
+in page order. Signed files store the name of the algorithm in the "/DigestAlgo" metadata field,
+so the verifier knows how to recompute the digest.
+
+Used libraries:
+- 'pypdf' for access to the page content streams
+- 'hashlib' for the per-page SHA256 digests and the final digest that gets signed
+- 'concurrent.futures' for hashing pages in parallel
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+## Value of the "/DigestAlgo" metadata field for digests computed with content_digest().
+## "sha256-merkle-v1" hashed the content streams only and is no longer accepted, the objects drawn by them could be changed.
+DIGEST_ALGO = "sha256-merkle-v2"
+## Page entries hashed together with the content streams, they define what the content streams draw and where.
+PAGE_KEYS = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+## Stream dictionary entries left out of the digest, they describe how the data is encoded, the decoded data is hashed instead.
+_ENCODING_KEYS = frozenset({"/Length", "/Filter", "/DecodeParms"})
+## Back references to the object tree, not content. pypdf does not copy them into the signed file.
+_LINK_KEYS = frozenset({"/Parent"})
+## Filters pypdf decodes itself on every machine. Streams with any other filter (image codecs, some needing external programs such as jbig2dec)
+## are hashed as stored, so the digest does not depend on what is installed where the file is signed or verified.
+_DECODED_FILTERS = frozenset({"/FlateDecode", "/Fl", "/LZWDecode", "/LZW", "/ASCIIHexDecode", "/AHx", "/ASCII85Decode", "/A85", "/RunLengthDecode", "/RL"})
+## Deepest nesting of objects below a page entry hashed by _object_digest(), real documents stay far below it.
+## It keeps a crafted file from exhausting the Python recursion limit.
+MAX_OBJECT_DEPTH = 200
+
+class DigestError(Exception):
+    """!
+    @brief Raised when the digest of a document cannot be computed because of its structure. The message can be shown to the user.
+    """
+
+def _page_streams(page):
+    """!
+    @brief Collects the content stream objects of a page.
+
+    @details Indirect objects are resolved here, on the calling thread, because pypdf reads them from the shared file handle.
+    The filter parameters are resolved as well, so decoding the streams later does not touch the file.
+
+    @param page: pypdf PageObject to read the /Contents entry from.
+
+    @return list[pypdf.generic.StreamObject]: The page content streams in order, empty if the page has no content.
+    """
+    if "/Contents" not in page:
+        return []
+    contents = page["/Contents"]
+    streams = [item.get_object() for item in contents] if isinstance(contents, ArrayObject) else [contents]
+    streams = [stream for stream in streams if isinstance(stream, StreamObject)]
+    for stream in streams:
+        for key in ("/Filter", "/DecodeParms"):
+            if key in stream:
+                stream[key]  # resolving the object caches it in the reader
+    return streams
+
+def _stream_data(stream):
+    """!
+    @brief Returns the decoded data of a stream, or its data as stored if one of its filters is not in _DECODED_FILTERS.
+
+    @param stream pypdf.generic.StreamObject: The stream to read.
+
+    @return bytes: The data to hash.
+    """
+    filters = stream.get("/Filter", ())
+    if isinstance(filters, str): # a single filter is a name, several are an array of names
+        filters = (filters,)
+    if all(name in _DECODED_FILTERS for name in filters):
+        return stream.get_data()
+    return stream._data # the encoded data, as stored in the file
+
+def _object_digest(obj, memo, in_progress, depth=0):
+    """!
+    @brief Computes a canonical SHA256 digest of a PDF object and of everything it refers to.
+
+    @details The digest depends only on the content of the objects, not on how the file is written: dictionary keys are sorted,
+    indirect references are replaced by the digest of the object they point to, and streams are hashed decoded, without their encoding entries.
+    "/Parent" links are skipped.
+    Signing copies the pages to a new file, which renumbers the objects and may reorder the keys, so this keeps the digest of the signed file unchanged.
+    Digests of indirect objects are kept in memo, so a font or image shared by many pages is decoded once.
+    A reference back to an object that is still being hashed (a cycle) is hashed as a fixed marker.
+    Runs on the calling thread, because resolving indirect objects reads from the shared file handle.
+
+    @param obj: The pypdf object to hash.
+    @param memo dict: Digests of the indirect objects hashed so far, keyed by (object number, generation).
+    @param in_progress set: The indirect objects being hashed at the moment.
+    @param depth (int): The nesting depth of obj below the page entry, at most MAX_OBJECT_DEPTH.
+
+    @throws DigestError If the objects are nested deeper than MAX_OBJECT_DEPTH.
+
+    @return bytes: The 32-byte SHA256 digest of the object.
+    """
+    if depth > MAX_OBJECT_DEPTH:
+        raise DigestError(f"The PDF objects are nested more than {MAX_OBJECT_DEPTH} levels deep, the document cannot be hashed")
+    if isinstance(obj, IndirectObject):
+        ref = (obj.idnum, obj.generation)
+        if ref in memo:
+            return memo[ref]
+        if ref in in_progress:
+            return hashlib.sha256(b"cycle").digest()
+        in_progress.add(ref)
+        try:
+            memo[ref] = _object_digest(obj.get_object(), memo, in_progress, depth + 1)
+        finally:
+            in_progress.discard(ref)
+        return memo[ref]
+
+    digest = hashlib.sha256()
+    if isinstance(obj, DictionaryObject): # streams are dictionaries with data
+        is_stream = isinstance(obj, StreamObject)
+        digest.update(b"stream" if is_stream else b"dict")
+        for key in sorted(obj.keys()):
+            if key in _LINK_KEYS or (is_stream and key in _ENCODING_KEYS):
+                continue
+            digest.update(key.encode("utf-8"))
+            digest.update(_object_digest(obj.raw_get(key), memo, in_progress, depth + 1))
+        if is_stream:
+            digest.update(hashlib.sha256(_stream_data(obj)).digest())
+    elif isinstance(obj, ArrayObject):
+        digest.update(b"array")
+        for item in obj:
+            digest.update(_object_digest(item, memo, in_progress, depth + 1))
+    else: # names, numbers, strings, booleans and null, hashed in their PDF syntax
+        buffer = io.BytesIO()
+        obj.write_to_stream(buffer)
+        digest.update(type(obj).__name__.encode("ascii"))
+        digest.update(buffer.getvalue())
+    return digest.digest()
+
+def _page_objects_digest(page, memo):
+    """!
+    @brief Hashes the page entries from PAGE_KEYS with _object_digest(), including the whole resource tree of the page.
+
+    @details The form XObjects drawn with "Do", their own resources, the fonts and the images are all reached from "/Resources",
+    so replacing any of them changes the digest even though the content streams of the page stay the same.
+    pypdf copies the inherited "/Resources", "/MediaBox", "/CropBox" and "/Rotate" from the page tree into every page when reading,
+    so inherited entries are covered too.
+
+    @param page: pypdf PageObject to hash the entries of.
+    @param memo dict: Digests of the indirect objects hashed so far, shared by all pages of the document.
+
+    @return bytes: The 32-byte SHA256 digest of the page entries.
+    """
+    digest = hashlib.sha256()
+    for key in PAGE_KEYS:
+        if key in page:
+            digest.update(key.encode("utf-8"))
+            digest.update(_object_digest(page.raw_get(key), memo, set()))
+    return digest.digest()
+
+def _hash_page(streams, objects_digest):
+    """!
+    @brief Decodes the content streams of one page and returns their SHA256 digest together with the digest of the page objects.
+
+    @param streams list[pypdf.generic.StreamObject]: The page content streams returned by _page_streams().
+    @param objects_digest (bytes): The digest of the page resources and boxes returned by _page_objects_digest().
+
+    @return bytes: The 32-byte SHA256 digest of the concatenated decoded streams followed by objects_digest.
+    """
+    digest = hashlib.sha256()
+    for stream in streams:
+        digest.update(_stream_data(stream))
+    digest.update(objects_digest) # fixed length, so it cannot be confused with content stream data
+    return digest.digest()
+
+def content_digest(pages):
+    """!
+    @brief Computes the digest of the decoded content streams of all pages.
+
+    @details The resources and boxes of every page are hashed first on the calling thread with _page_objects_digest(), objects shared by several pages are hashed once.
+    Then the content streams of every page are decoded and hashed with SHA256 on a thread pool (zlib decompression releases the GIL).
+    The 32-byte page digests are then joined in page order and hashed with SHA256 once more, so the result does not depend
+    on the order the threads finish in.
+
+    @param pages Iterable of pypdf PageObject: The pages of the document, usually PdfReader.pages.
+
+    @throws DigestError If the page objects are nested too deeply, see _object_digest().
+
+    @return hashlib.sha256: The digest object, ready to be signed or compared.
+    """
+    memo = {}
+    page_streams = []
+    objects_digests = []
+    for page in pages:
+        page_streams.append(_page_streams(page))
+        objects_digests.append(_page_objects_digest(page, memo))
+    with ThreadPoolExecutor() as executor:
+        page_digests = list(executor.map(_hash_page, page_streams, objects_digests))
+    return hashlib.sha256(b"".join(page_digests))
@@ -1,23 +1,77 @@
 """!
 @file sign_pdf.py
-@brief Contains the function to sign a PDF file using a private RSA key.
+@brief Contains the functions to sign a PDF file using a private RSA key.
 """
 
+import hashlib
+import os
+import threading
+from pathlib import Path
 from pypdf import PdfReader, PdfWriter
-from Crypto.Hash import SHA256
-from Crypto.Signature import pkcs1_15
-from Crypto.PublicKey import RSA
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, utils
+from pdf_digest import DIGEST_ALGO, content_digest
+from decrypt_key import KEY_CACHE_TTL, decrypt_private_key
+
+## Private keys imported in this session, keyed by SHA256 of the key bytes. Guarded by _IMPORTED_KEYS_LOCK, the expiry timers remove keys from another thread.
+_IMPORTED_KEYS = {}
+_IMPORTED_KEYS_LOCK = threading.Lock()
+## Maximum number of keys kept in _IMPORTED_KEYS, the oldest one is dropped first.
+_IMPORTED_KEYS_SIZE = 4
+
+def _forget_key(key_hash):
+    """!
+    @brief Removes an imported key from _IMPORTED_KEYS. Runs on the timer started by _import_key() once KEY_CACHE_TTL has passed.
+
+    @param key_hash (bytes)  The cache key of the imported key.
+    """
+    with _IMPORTED_KEYS_LOCK:
+        _IMPORTED_KEYS.pop(key_hash, None)
+
+def _import_key(private_key_bytes):
+    """!
+    @brief Imports an RSA private key, remembering the last few keys imported in this session for KEY_CACHE_TTL seconds.
+
+    @details Only the SHA256 of the key bytes is kept as the cache key, never the bytes themselves. A parsed key is dropped after KEY_CACHE_TTL seconds
+    by a daemon timer, the same time the derived AES key stays in the cache of decrypt_key.py.
+
+    @param private_key_bytes (bytes)  The private key in DER format, or in PEM format for keys generated by older versions of the RSA application.
+
+    @return RSAPrivateKey: The parsed private key.
+    """
+    key_hash = hashlib.sha256(private_key_bytes).digest()
+    with _IMPORTED_KEYS_LOCK:
+        key = _IMPORTED_KEYS.get(key_hash)
+    if key is not None:
+        return key
+
+    if private_key_bytes.startswith(b"-----BEGIN"):
+        key = serialization.load_pem_private_key(private_key_bytes, password=None)
+    else:
+        key = serialization.load_der_private_key(private_key_bytes, password=None)
+    with _IMPORTED_KEYS_LOCK:
+        if len(_IMPORTED_KEYS) >= _IMPORTED_KEYS_SIZE:
+            del _IMPORTED_KEYS[next(iter(_IMPORTED_KEYS))]
+        _IMPORTED_KEYS[key_hash] = key
+    timer = threading.Timer(KEY_CACHE_TTL, _forget_key, (key_hash,))
+    timer.daemon = True
+    timer.start()
+    return key
 
 def sign_pdf(pdf_path, private_key_bytes):
     """! 
     @brief Function is responsible for signing a PDF file using a private RSA key.
 
-    @details This function opens and reads the PDF file with use of pypdf library, extracts text from each page and computes the SHA256 digest of the content.
-    Later, the signature is created using the private key and the digest. Those data is then added to the PDF metadata as "/Signature" and "/Digest". Additionally,
-    the "/SignedBy" field is added with a value "User A". Finally, the signed PDF is saved to a new file with "_signed" suffix.
+    @details This function opens and reads the PDF file with use of pypdf library and computes the SHA256 digest of the decoded page content streams
+    and of the objects they draw (page resources such as form XObjects, fonts and images) with content_digest() from pdf_digest.py.
+    Later, the signature is created using the private key and the digest. Those data is then added to the PDF metadata as "/Signature" and "/Digest",
+    together with "/DigestAlgo" naming the digest algorithm. Additionally,
+    the "/SignedBy" field is added with a value "User A". Finally, the signed PDF is saved to a new file with "_signed" suffix added to the file name
+    (only the file name is changed, never the directories). The file is written under a temporary name first and then renamed,
+    the temporary file is removed if writing fails.
     The function uses the following libraries: 
     - 'pypdf' for PDF parsing
-    - Crypto.Hash.SHA256, Crypto.Signature.pkcs1_15, and Crypto.PublicKey.RSA from the 'pycryptodome' package for cryptographic operations.
+    - 'cryptography' for the RSA signature (PKCS#1 v1.5 over the prehashed SHA256 digest), computed by OpenSSL.
 
 
     @param pdf_path (str)  The path to the PDF file to verify.
@@ -26,31 +80,53 @@ def sign_pdf(pdf_path, private_key_bytes):
     @return  bool: Returns True if the signing was successful, False otherwise.
     """
     try:
-        key = RSA.import_key(private_key_bytes)
+        key = _import_key(private_key_bytes)
         reader = PdfReader(pdf_path)
         writer = PdfWriter()
+        writer.append(reader) # copies all pages in one pass, objects shared between pages are copied once
 
-        content_bytes = b""
-        for page in reader.pages:
-            writer.add_page(page)
-            text = page.extract_text()
-            if text:
-                content_bytes += text.encode('utf-8')
-
-        digest = SHA256.new(content_bytes) # digest - SHA256 hash of the PDF content
-        signature = pkcs1_15.new(key).sign(digest) # RSA signature of the digest
+        digest = content_digest(reader.pages) # digest - SHA256 hash of the PDF content
+        signature = key.sign(digest.digest(), padding.PKCS1v15(), utils.Prehashed(hashes.SHA256())) # RSA signature of the digest
 
         writer.add_metadata({
             "/SignedBy": "User",
             "/Signature": signature.hex(),
-            "/Digest": digest.hexdigest()
+            "/Digest": digest.hexdigest(),
+            "/DigestAlgo": DIGEST_ALGO
         })
 
-        output_path = pdf_path.replace(".pdf", "_signed.pdf")
-        with open(output_path, "wb") as f:
-            writer.write(f)
+        source_path = Path(pdf_path)
+        output_path = source_path.with_name(f"{source_path.stem}_signed{source_path.suffix}")
+        tmp_path = output_path.with_name(output_path.name + ".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                writer.write(f)
+            os.replace(tmp_path, output_path) # the signed file appears complete or not at all
+        except BaseException:
+            tmp_path.unlink(missing_ok=True) # do not leave a partial file next to the user's document
+            raise
 
         return True
     except Exception as e:
         print(f"[sign_pdf] Error: {e}")
         return False
+
+def sign_pdf_with_usb_key(pdf_path, usb_path, pin):
+    """!
+    @brief Decrypts the private key stored on the USB device and signs the PDF file with it.
+
+    @details This is the whole signing pipeline in one top-level function, so pades_gui.py can run it in a worker process.
+    decrypt_private_key() is used to decrypt the private key and sign_pdf() to sign the PDF file.
+
+    @param pdf_path (str)  The path to the PDF file to sign.
+    @param usb_path (str)  The path to the USB device with the encrypted private key.
+    @param pin (str)  The PIN for the private key.
+
+    @return  tuple[bool, str]: Whether the PDF was signed and the message to show to the user.
+    """
+    private_key = decrypt_private_key(usb_path, pin)
+    if private_key is None:
+        return False, "Failed to decrypt private key"
+    if not sign_pdf(pdf_path, private_key):
+        return False, "Failed to sign the PDF"
+    return True, "PDF has been signed successfully."
@@ -3,29 +3,45 @@
 @brief Contains the function to verify the signature of a PDF file using a public RSA key.
 """
 
+import functools
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pypdf import PdfReader
-from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
-from Crypto.Hash import SHA256
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, utils
+from pdf_digest import DIGEST_ALGO, DigestError, content_digest
 
-def verify_pdf_signature(pdf_path, public_key_path):
-    """! 
-    @brief Verify the signature of a PDF file using a public key.
+## PKCS#1 v1.5 padding of the signatures, created once and reused by every verification.
+_PADDING = padding.PKCS1v15()
+## The signatures are checked against an already computed SHA256 digest, so the DigestInfo template is fixed.
+_PREHASHED_SHA256 = utils.Prehashed(hashes.SHA256())
 
-    @details This function opens and reads the PDF file with use of pypdf library, extracts metadata and checks if signature exists. If there is no data
-    it returns False and proper error message. If the signature exists, it constructs PDF content as a text to compute the SHA256 digest and compares it with the stored digest.
-    If those digests match, it means that the PDF has not been changed after signing with the private key. 
-    Lastly, it reads the signature as bytes from earlier retrieved metadata, imports public key from the given path, and verifies the signature using the SHA256 digest
-    and the public key.
-    The function uses the following libraries: 
-    - 'pypdf' for PDF parsing
-    - Crypto.PublicKey.RSA, Crypto.Signature.pkcs1_15, Crypto.Hash.SHA256 from the 'pycryptodome' package for cryptographic operations.
+@functools.lru_cache(maxsize=32)
+def _load_public_key(public_key_path, mtime):
+    """!
+    @brief Loads and parses a PEM public key, keeping the parsed key for later verifications.
+
+    @details The modification time is part of the cache key, so a replaced key file is read again.
+
+    @param public_key_path (str): The path to the public key file in .PEM format.
+    @param mtime (float): The modification time of the file, used only as part of the cache key.
+
+    @return RSAPublicKey: The parsed public key.
+    """
+    with open(public_key_path, 'rb') as f:
+        return serialization.load_pem_public_key(f.read())
+
+def _verify_with_key(pdf_path, public_key):
+    """!
+    @brief Verifies the signature of one PDF file with an already loaded public key. See verify_pdf_signature() for the steps.
 
     @param pdf_path (str)  The path to the PDF file to verify.
-    @param public_key_path (str)  The path to the public key file in .PEM format.
+    @param public_key (RSAPublicKey)  The public key returned by _load_public_key().
 
-    @return  tuple[bool, str] Where the first element is a boolean indicating whether the signature is valid or invalid. Second part is a string 
-    with a message specifying the result of the verification process.
+    @return  tuple[bool, str]: Whether the signature is valid and the message specifying the result.
     """
     try:
         reader = PdfReader(pdf_path)
@@ -37,26 +53,82 @@ def verify_pdf_signature(pdf_path, public_key_path):
 
         signature_hex = metadata["/Signature"]
         digest_hex = metadata["/Digest"]
+        digest_algo = metadata.get("/DigestAlgo")
+        if digest_algo is not None and digest_algo != DIGEST_ALGO:
+            return False, f"Unsupported digest algorithm: {digest_algo}"
 
-        content_bytes = b""
-        for page in reader.pages:
-            text = page.extract_text()
-            if text:
-                content_bytes += text.encode('utf-8')
-
-        digest = SHA256.new(content_bytes)
+        signature = bytes.fromhex(signature_hex)
+        stored_digest = bytes.fromhex(digest_hex)
 
-        if digest.hexdigest() != digest_hex: # compare the digest of the current content with the stored digest
-            return False, "The PDF has been changed after signing!"
+        # the signature covers the stored digest, so it can be checked before the expensive content pass
+        public_key.verify(signature, stored_digest, _PADDING, _PREHASHED_SHA256)
 
-        signature = bytes.fromhex(signature_hex)
+        if digest_algo is None: # signed before "/DigestAlgo" was added, the digest covers the extracted text
+            digest = hashlib.sha256()
+            for page in reader.pages: # extract_text() is pure Python and holds the GIL, threads would only add overhead
+                text = page.extract_text()
+                if text:
+                    digest.update(text.encode('utf-8'))
+        else:
+            digest = content_digest(reader.pages)
 
-        with open(public_key_path, 'rb') as f:
-            public_key = RSA.import_key(f.read())
+        if not hmac.compare_digest(digest.digest(), stored_digest): # compare the digest of the current content with the stored digest, in constant time
+            return False, "The PDF has been changed after signing!"
 
-        pkcs1_15.new(public_key).verify(digest, signature)
         return True, "Valid signature"
-    except (ValueError, TypeError):
+    except DigestError as e:
+        return False, str(e)
+    except (InvalidSignature, ValueError, TypeError):
         return False, "Invalid signature"
     except Exception as e:
         return False, f"Error: {e}"
+
+def verify_pdf_signature(pdf_path, public_key_path):
+    """! 
+    @brief Verify the signature of a PDF file using a public key.
+
+    @details This function opens and reads the PDF file with use of pypdf library, extracts metadata and checks if signature exists. If there is no data
+    it returns False and proper error message. If the signature exists, it computes the SHA256 digest the same way it was computed during signing and compares it with the stored digest.
+    Files with "/DigestAlgo" set are hashed with content_digest() from pdf_digest.py, older files without it are hashed from the extracted page text.
+    The text of the pages is extracted and hashed in page order.
+    If those digests match, it means that the PDF has not been changed after signing with the private key. 
+    Before the content is hashed, it reads the signature as bytes from earlier retrieved metadata and verifies the signature with the public key imported from the given path
+    over the stored digest (PKCS#1 v1.5 with a prehashed SHA256). This check takes milliseconds, so a wrong key or a forged signature is rejected
+    without extracting the text of the whole document. The stored digest is then trusted only if it matches the digest of the current content.
+    The function uses the following libraries: 
+    - 'pypdf' for PDF parsing
+    - 'hashlib' for hashing the extracted text of legacy files (OpenSSL, uses the CPU's SHA instructions when available)
+    - 'cryptography' for loading the public key and verifying the RSA signature with OpenSSL.
+    This is verify_many() called with a single file.
+
+    @param pdf_path (str)  The path to the PDF file to verify.
+    @param public_key_path (str)  The path to the public key file in .PEM format.
+
+    @return  tuple[bool, str] Where the first element is a boolean indicating whether the signature is valid or invalid. Second part is a string 
+    with a message specifying the result of the verification process.
+    """
+    return verify_many([pdf_path], public_key_path)[0]
+
+def verify_many(pdf_paths, public_key_path):
+    """!
+    @brief Verifies the signatures of many PDF files signed with the same key.
+
+    @details The public key is read and parsed once with _load_public_key() and shared by all files. The files are verified
+    with _verify_with_key() on a thread pool, the RSA check of each file is cheap, most of the time is spent reading and hashing the PDF content.
+
+    @param pdf_paths (list[str])  The paths to the PDF files to verify.
+    @param public_key_path (str)  The path to the public key file in .PEM format.
+
+    @return  list[tuple[bool, str]]: The result of verify_pdf_signature() for every file, in the order of pdf_paths.
+    """
+    try:
+        public_key = _load_public_key(public_key_path, os.path.getmtime(public_key_path))
+    except (ValueError, TypeError):
+        return [(False, "Invalid signature")] * len(pdf_paths)
+    except Exception as e:
+        return [(False, f"Error: {e}")] * len(pdf_paths)
+
+    if len(pdf_paths) == 1:
+        return [_verify_with_key(pdf_paths[0], public_key)]
+    with ThreadPoolExecutor() as executor:
+        return list(executor.map(_verify_with_key, pdf_paths, [public_key] * len(pdf_paths)))
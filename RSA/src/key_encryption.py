@@ -1,40 +1,157 @@
 """!
 @file key_encryption.py
 @brief Contains the function to encrypt a private key using AES symmetric encryption with a PIN given by the user.
+
+@details The key is derived with scrypt from hashlib. Only if Python's OpenSSL has no scrypt, the key derivation falls back to a native PBKDF2:
+the optional 'fastpbkdf2' package or OpenSSL through hashlib. OpenSSL chooses
+the SHA-NI (x86) or SHA2 (ARMv8) instructions at runtime when the CPU has them. A Python built without OpenSSL falls back
+to a pure-Python PBKDF2 that is far too slow for 600,000 iterations, a warning is shown in that case.
 """
 
-from Crypto.Cipher import AES
-from Crypto.Protocol.KDF import PBKDF2
+import functools
+import hashlib
 import os
+import time
+import warnings
+
+from rsa_utils import CryptoError
+
+try:
+    from fastpbkdf2 import pbkdf2_hmac
+except ImportError:
+    from hashlib import pbkdf2_hmac
+
+if pbkdf2_hmac.__module__ not in ("_hashlib", "fastpbkdf2"):
+    warnings.warn("PBKDF2 is not backed by OpenSSL, encrypting the private key will be very slow", RuntimeWarning)
+
+## Magic bytes starting every versioned key file, must match decrypt_key.py in the PAdES application.
+KEY_FILE_MAGIC = b"PKEY"
+## Format version written by encrypt_private_key(): scrypt with its parameters in the header and AES-GCM.
+KEY_FILE_VERSION = 4
+## Format version written when scrypt is not available: PBKDF2-HMAC-SHA256 with the iteration count in the header and AES-GCM.
+PBKDF2_KEY_FILE_VERSION = 3
+## Whether hashlib provides scrypt, it is missing when Python is linked against an OpenSSL without it.
+SCRYPT_AVAILABLE = hasattr(hashlib, "scrypt")
+## scrypt cost parameters, N = 2**17 and r = 8 use 128 MiB of memory per derivation, the OWASP recommendation.
+SCRYPT_LOG2_N = 17
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+## Duration of the last key derivation in this session in seconds, None before the first one. Read by estimated_kdf_seconds().
+_last_kdf_seconds = None
+## Lowest PBKDF2 iteration count ever written, calibration can only raise it.
+MIN_KDF_ITERATIONS = 600000
+## Highest iteration count written, must not be above MAX_KDF_ITERATIONS in decrypt_key.py of the PAdES application.
+MAX_KDF_ITERATIONS = 20000000
+## Time in seconds the key derivation should take on this machine.
+KDF_TARGET_SECONDS = 0.75
+
+@functools.lru_cache(maxsize=None)
+def calibrate_iterations(target_seconds=KDF_TARGET_SECONDS):
+    """!
+    @brief Measures the PBKDF2 speed of this machine and returns the iteration count that takes about target_seconds.
+
+    @details A sample derivation of 100,000 iterations is timed and the count is scaled linearly, PBKDF2 time grows linearly with the iterations.
+    The result is clamped to MIN_KDF_ITERATIONS and MAX_KDF_ITERATIONS and kept for the rest of the session,
+    so the measurement runs once. rsa_gui.py calls it in the background at startup.
+
+    @param target_seconds (float)  The wanted duration of one key derivation.
+
+    @return int: The calibrated iteration count.
+    """
+    sample_iterations = 100000
+    start = time.perf_counter()
+    pbkdf2_hmac("sha256", b"calibration", os.urandom(16), sample_iterations, 32)
+    elapsed = time.perf_counter() - start
+    iterations = int(sample_iterations * target_seconds / max(elapsed, 1e-6))
+    return min(max(iterations, MIN_KDF_ITERATIONS), MAX_KDF_ITERATIONS)
+
+def scrypt_maxmem(log2_n, r, p):
+    """!
+    @brief Returns the memory limit to pass to hashlib.scrypt() for the given parameters.
 
-def encrypt_private_key(private_key, pin, progress_callback):
+    @details OpenSSL needs 128 * r * (N + p + 2) bytes, the default limit of 32 MiB is too low for N = 2**17. One MiB is added as a margin.
+
+    @param log2_n (int)  The binary logarithm of the scrypt cost N.
+    @param r (int)  The scrypt block size.
+    @param p (int)  The scrypt parallelization.
+
+    @return int: The memory limit in bytes.
+    """
+    return 128 * r * (2 ** log2_n + p + 2) + 1024 * 1024
+
+def estimated_kdf_seconds():
+    """!
+    @brief Estimates how long the next key derivation of encrypt_private_key() will take, so the GUI can show its progress.
+
+    @details The duration of the last derivation in this session is used. Before the first one, KDF_TARGET_SECONDS is returned, which is what the calibrated
+    PBKDF2 takes and close to what scrypt with the default parameters takes on current CPUs.
+
+    @return float: The expected duration in seconds.
+    """
+    return _last_kdf_seconds if _last_kdf_seconds is not None else KDF_TARGET_SECONDS
+
+def encrypt_private_key(private_key, pin, progress_callback, iterations=None):
     """! 
-    @brief Encrypts a private key using AES symetric encryption, where the encryption key is the user-provided PIN using PBKDF2 (Password-Based Key Derivation Function 2).
+    @brief Encrypts a private key using AES symetric encryption, where the encryption key is derived from the user-provided PIN using scrypt.
 
     @details
-    Derives a 256-bit AES key from a user-provided PIN using PBKDF2 with a 128-bit random salt and 600,000 iterations. The private key is encrypted using AES in EAX mode.
-    Progress is reported via a callback messages to update the GUI to inform the user about process.
+    Derives a 256-bit AES key from a user-provided PIN using scrypt with a 128-bit random salt, N = 2**17, r = 8 and p = 1. scrypt is memory-hard,
+    every guess costs an attacker 128 MiB of memory as well as time, so GPUs and ASICs gain far less over the user's CPU than with PBKDF2.
+    If hashlib has no scrypt, the key is derived with PBKDF2-HMAC-SHA256 instead. Its iteration count comes from calibrate_iterations(),
+    so the derivation takes about KDF_TARGET_SECONDS on this machine, but never less than 600,000 iterations. The private key is encrypted using AES in GCM mode,
+    which runs on the AES-NI and carry-less multiplication instructions of the CPU.
+    Either way the derivation is a single native call, hashlib.scrypt() in OpenSSL by default (version 4 files).
+    The following applies only to the PBKDF2 fallback (version 3 files), used when hashlib.scrypt is unavailable: if the optional `fastpbkdf2` package
+    is installed it is used, it computes the HMAC inner and outer states once per PIN, which makes it about twice as fast. Otherwise hashlib.pbkdf2_hmac()
+    runs all iterations in OpenSSL, which uses the CPU's SHA instructions when available.
+    Progress is reported via a callback messages before and after the key derivation to update the GUI to inform the user about process,
+    the callback is never called during the derivation. Its duration is measured for estimated_kdf_seconds().
 
     Used libraries:
-    - `pycryptodome` – for AES and PBKDF2 (`Crypto.Cipher.AES`, `Crypto.Protocol.KDF`)
+    - `pycryptodome` – for AES (`Crypto.Cipher.AES`)
+    - `hashlib` – for scrypt, and for PBKDF2 in the fallback without scrypt, or `fastpbkdf2` (optional) for that PBKDF2 when installed
     - `os` – for secure salt generation
 
     @param private_key (bytes)  The private key to encrypt.
-    @param pin (str)  The password used to derive the encryption key.
+    @param pin (str | bytes)  The password used to derive the encryption key, a str is encoded as UTF-8.
     @param progress_callback (Callable[[str], None])  A callback function to update the GUI messages.
+    @param iterations (int | None)  The PBKDF2 iteration count when scrypt is not available, calibrate_iterations() is used if None.
+
+    @throws CryptoError If the crypto libraries are missing or the key derivation or encryption fails.
 
-    @return  The encrypted private key as bytes, or None if an error occurs.
+    @return  The encrypted private key as bytes.
     The resulting encrypted output is composed of: 
-        salt (16 bytes) + nonce (16 bytes) + authentication tag (16 bytes) + ciphertext (N bytes).
+        "PKEY" (4 bytes) + version 4 (1 byte) + log2(N), r, p (1 byte each) + salt (16 bytes) + nonce (12 bytes) + authentication tag (16 bytes)
+        + ciphertext (N bytes),
+    or without scrypt:
+        "PKEY" (4 bytes) + version 3 (1 byte) + iterations (4 bytes, big endian) + salt (16 bytes) + nonce (12 bytes) + authentication tag (16 bytes)
+        + ciphertext (N bytes).
     """
+    global _last_kdf_seconds
+    salt = os.urandom(16)  # 128-bit salt (16 bytes)
+    try:
+        from Crypto.Cipher import AES # imported on first use, it is not needed to open the GUI
+    except ImportError as e:
+        raise CryptoError(f"pycryptodome is not installed: {e}") from e
+
+    progress_callback("Deriving key...")
+    pin_bytes = pin.encode("utf-8") if isinstance(pin, str) else pin
+    kdf_start = time.perf_counter()
     try:
-        salt = os.urandom(16)  # 128-bit salt (16 bytes)
-        iterations = 600000
-        key = PBKDF2(pin, salt, dkLen=32, count=iterations)
-        progress_callback("Encrypting...")
-        cipher = AES.new(key, AES.MODE_EAX)
-        encrypted_key, tag = cipher.encrypt_and_digest(private_key)
-        return salt + cipher.nonce + tag + encrypted_key
-    except Exception as e:
-        print(f"Error encrypting private key: {e}")
-        return None
\ No newline at end of file
+        if SCRYPT_AVAILABLE:
+            key = hashlib.scrypt(pin_bytes, salt=salt, n=2 ** SCRYPT_LOG2_N, r=SCRYPT_R, p=SCRYPT_P,
+                                 maxmem=scrypt_maxmem(SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P), dklen=32)
+            header = KEY_FILE_MAGIC + bytes([KEY_FILE_VERSION, SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P])
+        else:
+            if iterations is None:
+                iterations = calibrate_iterations()
+            key = pbkdf2_hmac("sha256", pin_bytes, salt, iterations, 32)
+            header = KEY_FILE_MAGIC + bytes([PBKDF2_KEY_FILE_VERSION]) + iterations.to_bytes(4, "big")
+    except (ValueError, MemoryError) as e: # scrypt fails with ValueError when OpenSSL cannot allocate its memory
+        raise CryptoError(f"Key derivation failed: {e}") from e
+    _last_kdf_seconds = time.perf_counter() - kdf_start
+    progress_callback("Encrypting...")
+    cipher = AES.new(key, AES.MODE_GCM, nonce=os.urandom(12))  # 96-bit nonce, the size GCM is designed for
+    encrypted_key, tag = cipher.encrypt_and_digest(private_key)
+    return b"".join((header, salt, cipher.nonce, tag, encrypted_key))  # one allocation for the whole file content
\ No newline at end of file
@@ -1,25 +1,130 @@
 """!
 @file key_generation.py
-@brief Contains the function to generate RSA keys in .PEM format.
+@brief Contains the function to generate RSA keys, the private key in DER format and the public key in .PEM format.
+
+@details Key pairs can be generated ahead of time: start_key_pregeneration() starts worker processes that keep a few key pairs ready,
+and generate_rsa_keys() then returns one of them immediately. The prime search runs in separate processes, so it does not compete
+with the GUI for the GIL.
 """
 
-from Crypto.PublicKey import RSA
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import multiprocessing
+import os
+import queue
+import threading
 
-def generate_rsa_keys():
-    """! 
-    @brief Generating two RSA keys: a private key and a public key (4096 bits). Both keys are stored in PEM format in bytes format.
+from rsa_utils import CryptoError
 
-    @details
-    This function uses the `Crypto.PublicKey.RSA` module from the `pycryptodome` package to generate a secure RSA key pair.
-    The private and public keys are exported in .PEM format as bytes.
+## Default RSA key size in bits, 2048-bit keys are accepted for signatures by NIST until 2030 and generate several times faster than 4096-bit ones.
+DEFAULT_KEY_SIZE = 2048
+## Number of key pairs of every size kept ready by the pregeneration.
+PREGENERATED_KEYS = 2
+## Number of key pairs generated at the same time, one core is left for the GUI.
+PREGENERATION_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+
+## Worker processes generating the key pairs, None until start_key_pregeneration() is called.
+_pool = None
+## Key pairs generated ahead of time by key size, filled by _prefill() and emptied by generate_rsa_keys().
+_pregenerated = {}
+## Threads running _prefill() by key size, a size is added by start_key_pregeneration().
+_prefill_threads = {}
+
+def _generate_key_pair(bits):
+    """!
+    @brief Generates one RSA key pair. Called directly or in a worker process of the pregeneration.
+
+    @param bits (int)  The key size in bits.
+
+    @throws CryptoError If the `cryptography` package is missing or the key size is not supported.
+
+    @return Tuple ([bytes, bytes]): The private key in DER and the public key in PEM format.
+    """
+    try:
+        # imported here, not at the top of the module, so the GUI window opens without waiting for the crypto libraries
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError as e:
+        raise CryptoError(f"cryptography is not installed: {e}") from e
+
+    try:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+    except ValueError as e:
+        raise CryptoError(f"Invalid RSA key size {bits}: {e}") from e
+    private_key = key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption())
+    public_key = key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return private_key, public_key
+
+def _prefill(bits):
+    """!
+    @brief Keeps the queue of one key size in _pregenerated filled with key pairs generated in the worker processes. Runs in a thread started by start_key_pregeneration().
+
+    @details PREGENERATION_WORKERS key pairs are generated at the same time and queued in the order they finish. The time to find the primes
+    varies a lot between runs, so the first of several parallel generations finishes much sooner than a single one would,
+    and the others are not wasted, they are queued for the next calls.
+    The queue blocks the thread while it is full, a new key pair is requested for every one that finished.
+    The thread ends if a generation fails or the pool was shut down, generate_rsa_keys() then generates the keys directly
+    and reports a real error to its caller.
 
-    @return Tuple ([str | None, str | None]): containing the private key and public key in bytes format. If an error occurs, returned tuple is (None, None).
+    @param bits (int)  The key size in bits.
     """
     try:
-        key = RSA.generate(4096) # 4096-bit RSA key
-        private_key = key.export_key()
-        public_key = key.publickey().export_key()
-        return private_key, public_key
+        pending = {_pool.submit(_generate_key_pair, bits) for _ in range(PREGENERATION_WORKERS)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                _pregenerated[bits].put(future.result())
+                pending.add(_pool.submit(_generate_key_pair, bits))
     except Exception as e:
-        print(f"Error generating RSA keys: {e}")
-        return None, None
\ No newline at end of file
+        print(f"Key pregeneration stopped: {e}")
+
+def start_key_pregeneration(bits=DEFAULT_KEY_SIZE):
+    """!
+    @brief Starts generating key pairs of the given size in the background, so later generate_rsa_keys() calls for that size return immediately.
+
+    @details PREGENERATION_WORKERS worker processes are created with the "spawn" start method on the first call, forking a process that runs Tk
+    and other threads is not safe. The processes are shared by all key sizes. Calling the function again for the same size does nothing.
+
+    @param bits (int)  The key size in bits.
+    """
+    global _pool
+    if bits in _prefill_threads:
+        return
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PREGENERATION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    _pregenerated[bits] = queue.Queue(maxsize=PREGENERATED_KEYS)
+    _prefill_threads[bits] = threading.Thread(target=_prefill, args=(bits,), daemon=True)
+    _prefill_threads[bits].start()
+
+def stop_key_pregeneration():
+    """!
+    @brief Shuts the worker processes of the pregeneration down. Call it before the application exits.
+    """
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+
+def generate_rsa_keys(bits=DEFAULT_KEY_SIZE):
+    """!
+    @brief Generating two RSA keys: a private key and a public key (2048 bits by default). The private key is stored in DER format and the public key in PEM format, in bytes format.
+
+    @details
+    This function uses the `cryptography` package to generate a secure RSA key pair with the public exponent 65537. The prime search runs in OpenSSL,
+    which is several times faster than pycryptodome's generator.
+    The private key is exported in the PKCS#1 DER format: it is only ever encrypted and read back by the PAdES application, so the base64 armour of PEM
+    would only make it a third larger. The public key is shared with other people and stays in the SubjectPublicKeyInfo .PEM format, as bytes.
+    If start_key_pregeneration() was called for the key size, a key pair generated ahead of time is returned, waiting for the worker processes if none is ready yet.
+    Otherwise, or if the pregeneration stopped, the keys are generated in the calling thread.
+
+    @param bits (int)  The key size in bits, 2048 or 4096.
+
+    @throws CryptoError If the keys cannot be generated.
+
+    @return Tuple ([bytes, bytes]): containing the private key and public key in bytes format.
+    """
+    prefill_thread = _prefill_threads.get(bits)
+    while prefill_thread is not None:
+        try:
+            return _pregenerated[bits].get(timeout=0.5)
+        except queue.Empty:
+            if not prefill_thread.is_alive():
+                break
+    return _generate_key_pair(bits)
@@ -6,50 +6,166 @@
 import os
 import shutil
 
-def save_keys(private_key, public_key, usb_path, public_key_path, key_name):
-    """! 
-    @brief Function is responsible for saving the private key on the USB device and public key in specified by the user path.
+def _write_synced(path, data, mode=0o644):
+    """!
+    @brief Writes a key file with unbuffered writes and flushes it to the device.
+
+    @details The file is opened with os.open(), so the data goes from the bytes object straight to the kernel without Python's buffer in between,
+    and is written with a single os.write() call for a key of this size, larger Python buffers would not change the number of writes.
+    os.fsync() then flushes it to the device once, so the key is on the USB drive when the success message is shown, even if the drive is pulled out right after.
+    O_DIRECT is not used, it needs page aligned buffers, is not supported by every file system used on USB drives and does not exist on Windows.
+
+    @param path (str)  The path of the key file.
+    @param data (bytes)  The content of the file.
+    @param mode (int)  The permissions of a newly created file, where the platform supports them.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), mode)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _sync_directory(path):
+    """!
+    @brief Flushes a directory entry change, such as a rename, to the device.
+
+    @details Directories cannot be opened on Windows, where a rename is committed by the file system itself, so the error is ignored there.
+
+    @param path (str)  The path of the directory.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def save_private_key(private_key, usb_path, key_name):
+    """!
+    @brief Saves the encrypted private key in the "keys" catalog on the USB device.
 
-    @details Private key is saved in the "keys" catalog on the USB device. If the "keys" folder already exists, all the files inside it are delated
-    to ensure that the folder is empty before saving the new keys. The public key is saved in the specified path provided by the user. Function uses shutil library, 
+    @details If the "keys" folder already exists, all the other files inside it are delated, so that the folder holds only the new key.
+    The private key is first written with _write_synced() to a temporary file, which is then renamed to the final name with os.replace(), and the other old keys are removed
+    only after that. A drive pulled out at any moment leaves a complete old or new key, never a truncated file. The folder is listed once before writing,
+    if it holds nothing but a key of the same name, which the rename replaces, the removal pass over the folder is skipped. Function uses shutil library, 
     which is part of default library to remove files and directories.
 
-    @param private_key (bytes)  The private key to save, generated from generate_rsa_keys().
-    @param public_key (bytes)  The public key to save, generated from generate_rsa_keys().
+    @param private_key (bytes)  The encrypted private key to save.
     @param usb_path (str)  The path to the USB device where the private key will be saved, the device was chosen from the list by user.
+    @param key_name (str)  The name to use for the saved key.
+
+    @throws OSError If the folder cannot be created or a file cannot be written or removed.
+
+    @return Tuple ([str, bool]): The path to the saved private key and a boolean indicating if old keys were removed.
+    """
+    keys_folder = os.path.join(usb_path, "keys")
+    key_file_name = f"{key_name}_private_key.enc"
+    priv_key_path = os.path.join(keys_folder, key_file_name)
+    tmp_key_path = priv_key_path + ".tmp"
+
+    os.makedirs(keys_folder, exist_ok=True)
+    old_entries = set(os.listdir(keys_folder)) - {key_file_name + ".tmp"}
+    _write_synced(tmp_key_path, private_key, 0o600)
+    folder_was_cleared = key_file_name in old_entries
+    os.replace(tmp_key_path, priv_key_path) # the new key is complete on the drive before anything old is removed
+    _sync_directory(keys_folder)
+    if old_entries <= {key_file_name}:
+        return priv_key_path, folder_was_cleared
+
+    # scandir() returns the entry types with the listing, so no extra stat call is made per entry
+    with os.scandir(keys_folder) as entries:
+        for entry in entries:
+            if entry.path == priv_key_path:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+            folder_was_cleared = True
+
+    return priv_key_path, folder_was_cleared
+
+def stage_public_key(public_key, public_key_path, key_name):
+    """!
+    @brief Writes the public key under a temporary name next to its final path, so it does not replace an existing key yet.
+
+    @details The RSA GUI writes the public key while the private key is being encrypted. Until the private key is saved too,
+    a public key of the same name from an earlier pair must stay untouched, otherwise a failure would leave a new public key next to the old private key.
+    save_keys() gives the file its final name with commit_public_key() once the private key is saved, discard_public_key() removes it.
+
+    @param public_key (bytes)  The public key to save, generated from generate_rsa_keys().
     @param public_key_path (str)  The path where the public key will be saved, specified by the user.
+    @param key_name (str)  The name to use for the saved key.
+
+    @throws OSError If the file cannot be written, the temporary file is removed on any failure.
+
+    @return str: The path to the temporary file.
+    """
+    tmp_key_path = os.path.join(public_key_path, f"{key_name}_public_key.pem.tmp")
+    try:
+        _write_synced(tmp_key_path, public_key)
+    except BaseException:
+        discard_public_key(tmp_key_path)
+        raise
+    return tmp_key_path
+
+def commit_public_key(tmp_key_path):
+    """!
+    @brief Renames a public key written by stage_public_key() to its final name, replacing an older key of the same name.
+
+    @param tmp_key_path (str)  The path returned by stage_public_key().
+
+    @throws OSError If the file cannot be renamed.
+
+    @return str: The path to the saved public key.
+    """
+    pub_key_path = tmp_key_path[:-len(".tmp")]
+    os.replace(tmp_key_path, pub_key_path)
+    _sync_directory(os.path.dirname(pub_key_path))
+    return pub_key_path
+
+def discard_public_key(tmp_key_path):
+    """!
+    @brief Removes a public key written by stage_public_key() that will not be used. A missing file is ignored.
+
+    @param tmp_key_path (str)  The path returned by stage_public_key().
+    """
+    try:
+        os.remove(tmp_key_path)
+    except OSError:
+        pass
+
+def save_keys(private_key, tmp_pub_key_path, usb_path, key_name):
+    """! 
+    @brief Function is responsible for saving the private key on the USB device and public key in specified by the user path.
+
+    @details The public key was already written under a temporary name with stage_public_key(), while the private key was being encrypted.
+    The private key is saved with save_private_key() in the "keys" catalog on the USB device, which is cleared of older keys.
+    Only then the public key replaces an older one of the same name with commit_public_key(), so a failure never leaves a new public key next to the old private key.
+    If saving fails for any reason, the temporary public key is removed with discard_public_key().
+    Both keys are written with _write_synced() and flushed to their devices.
+
+    @param private_key (bytes)  The encrypted private key to save.
+    @param tmp_pub_key_path (str)  The temporary public key file returned by stage_public_key().
+    @param usb_path (str)  The path to the USB device where the private key will be saved, the device was chosen from the list by user.
     @param key_name (str)  The name to use for the saved keys.
 
-    @return Tuple ([str | None, str | None, bool]): containing the paths to the saved private and public keys, and a boolean indicating if the keys folder was cleared to 
-    show this information on the success text box. If an error occurs it returns (None, None, False).
+    @throws OSError If one of the keys cannot be saved.
+
+    @return Tuple ([str, str, bool]): containing the paths to the saved private and public keys, and a boolean indicating if the keys folder was cleared to 
+    show this information on the success text box.
     """
     try:
-        keys_folder = os.path.join(usb_path, "keys")
-        folder_was_cleared = False
-
-        if not os.path.exists(keys_folder):
-            os.makedirs(keys_folder)
-        else:
-            for filename in os.listdir(keys_folder):
-                file_path = os.path.join(keys_folder, filename)
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                    folder_was_cleared = True
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-                    folder_was_cleared = True
-
-        priv_key_path = os.path.join(keys_folder, f"{key_name}_private_key.enc")
-        pub_key_path = os.path.join(public_key_path, f"{key_name}_public_key.pem")
-        
-        with open(priv_key_path, "wb") as priv_file:
-            priv_file.write(private_key)
-        
-        with open(pub_key_path, "wb") as pub_file:
-            pub_file.write(public_key)
-            
-        return priv_key_path, pub_key_path, folder_was_cleared
-    
-    except Exception as e:
-        print(f"Error saving keys: {e}")
-        return None, None, False
\ No newline at end of file
+        priv_key_path, folder_was_cleared = save_private_key(private_key, usb_path, key_name)
+        pub_key_path = commit_public_key(tmp_pub_key_path)
+    except BaseException: # not only OSError, the staged file is removed whatever went wrong
+        discard_public_key(tmp_pub_key_path)
+        raise
+    return priv_key_path, pub_key_path, folder_was_cleared
@@ -5,23 +5,54 @@
 and save the keys to a USB device and a specified public key path. The GUI is built using Tkinter.
 """
 
-from tkinter import Tk, Label, Entry, Button, filedialog, messagebox, IntVar, ttk
+from tkinter import Tk, Label, Entry, Button, Checkbutton, BooleanVar, filedialog, messagebox, ttk
 from tkinter.ttk import Progressbar
 from key_generation import *
 from key_encryption import *
 from key_saving import *
 from rsa_utils import *
+from concurrent.futures import ThreadPoolExecutor
 import os
 import threading
+import time
 
-def update_usb_devices():
+## Minimum time in seconds between two updates of the progress label, about one per frame at 30 Hz.
+PROGRESS_INTERVAL = 0.033
+## Newest progress message not shown yet, None if no update is scheduled. Guarded by progress_lock.
+pending_progress = None
+progress_lock = threading.Lock()
+## Time the running key derivation started at (time.monotonic()), None when no derivation is shown. Used only on the Tk thread.
+kdf_started = None
+
+def warm_up_encryption():
+    """!
+    @brief Prepares the key encryption in a background thread started by main_rsa().
+
+    @details Imports the AES module, which key_encryption.py imports only on first use, and, when the PBKDF2 fallback is used,
+    measures the iteration count with calibrate_iterations(), so the first click does not wait for either. The cryptography package is imported in the worker process of the key pregeneration.
+    """
+    import Crypto.Cipher.AES
+    if not SCRYPT_AVAILABLE:
+        calibrate_iterations()
+
+def update_key_size():
+    """!
+    @brief Called when the 4096-bit checkbox is toggled. Starts pregenerating 4096-bit keys the first time it is checked,
+    so they are ready by the time the user clicks the generate button.
+    """
+    if large_key_var.get():
+        start_key_pregeneration(4096)
+
+def update_usb_devices(refresh=False):
     """! 
     @brief Allows to update the list of USB devices currently connected to the computer.
 
     @details It makes sure that if there is at least one USB device connected, it will be selected by default in the GUI and if 
     there are no USB devices connected, the box will be empty.
+
+    @param refresh (bool): If True, the cached list of USB devices is ignored, used by the "Refresh USB Devices" button.
     """
-    usb_devices = get_usb_devices()
+    usb_devices = get_usb_devices(refresh)
     usb_path_entry['values'] = usb_devices
     if usb_devices:
         usb_path_entry.current(0)
@@ -41,32 +72,173 @@ def browse_public_key_path():
         pub_key_path_entry.delete(0, 'end')
         pub_key_path_entry.insert(0, pub_key_path)
 
-def generate_and_save_keys():
+def report_progress(message):
+    """!
+    @brief Shows a progress message in the GUI. Safe to call from the worker thread.
+
+    @details The worker thread never touches the widgets itself, the label is updated on the Tk thread with root.after().
+    Messages arriving faster than PROGRESS_INTERVAL are coalesced, only the newest one is shown,
+    so the label is redrawn at most about 30 times per second.
+
+    @param message (str)  The message to show.
+    """
+    global pending_progress
+    with progress_lock:
+        scheduled = pending_progress is not None
+        pending_progress = message
+    if not scheduled:
+        root.after(int(PROGRESS_INTERVAL * 1000), show_pending_progress)
+
+def show_pending_progress():
+    """!
+    @brief Shows the newest message passed to report_progress(). Runs on the Tk thread.
+    """
+    global pending_progress
+    with progress_lock:
+        message, pending_progress = pending_progress, None
+    progress_label.config(text=message)
+
+def start_kdf_progress(expected_seconds):
+    """!
+    @brief Switches the progress bar to show how much of the expected key derivation time has passed. Runs on the Tk thread.
+
+    @details The key derivation is a single native call without progress steps, so the bar is driven by a Tk timer comparing the elapsed time
+    with estimated_kdf_seconds(). The worker thread is never interrupted for the progress.
+
+    @param expected_seconds (float)  The expected duration of the key derivation.
+    """
+    global kdf_started
+    kdf_started = time.monotonic()
+    progress_bar.stop()
+    progress_bar.config(mode="determinate", maximum=expected_seconds, value=0)
+    root.after(int(PROGRESS_INTERVAL * 1000), advance_kdf_progress)
+
+def advance_kdf_progress():
+    """!
+    @brief Moves the progress bar to the elapsed time of the key derivation and schedules itself again until stop_kdf_progress() is called.
+
+    @details The bar stops just short of the end if the derivation takes longer than expected.
+    """
+    if kdf_started is None:
+        return
+    maximum = float(progress_bar.cget("maximum"))
+    progress_bar.config(value=min(time.monotonic() - kdf_started, maximum * 0.99))
+    root.after(int(PROGRESS_INTERVAL * 1000), advance_kdf_progress)
+
+def stop_kdf_progress():
+    """!
+    @brief Stops the key derivation progress and returns the progress bar to its indeterminate animation. Runs on the Tk thread.
+    """
+    global kdf_started
+    kdf_started = None
+    progress_bar.config(mode="indeterminate", value=0)
+    progress_bar.start(10)
+
+def generate_and_save_keys(pin, usb_path, public_key_path, key_name, bits):
     """! 
-    @brief Main logic for GUI, data validation, key generation, encryption and keys saving.
+    @brief Key generation, encryption and keys saving. Runs in the worker thread started by handle_generate_button_click().
+
+    @details It takes a pair of RSA keys generated in the background with the generate_rsa_keys() function from key_generation.py  file (see start_key_pregeneration()).
+    The generated keys are then encrypted using the encrypt_private_key() function from key_encryption.py file, where the PIN is used to derive the encryption key.
+    The keys are saved using the stage_public_key() and save_keys() functions from key_saving.py file, where the private key is saved on the USB device and the public key
+    is saved in the specified path. The public key does not depend on the encryption, so it is written under a temporary name with stage_public_key()
+    in a second thread while the key derivation runs. save_keys() replaces an existing public key of the same name only after the private key
+    was saved, so a failure never deletes the user's old public key or leaves a new public key next to the old private key.
+    On any failure only the temporary file is removed with discard_public_key().
+    The called functions raise CryptoError or OSError on failure, both are caught here and turned into the error message.
+
+    During the process, status messages are shown with report_progress() and the progress bar follows the key derivation time (see start_kdf_progress()). The function does not touch the widgets, the result is returned
+    and shown by finish_generating() on the Tk thread.
+
+    @param pin (str)  The PIN to encrypt the private key with.
+    @param usb_path (str)  The USB path where the private key will be saved.
+    @param public_key_path (str)  The folder where the public key will be saved.
+    @param key_name (str)  The name of the generated keys.
+    @param bits (int)  The RSA key size, 2048 or 4096.
+
+    @return tuple[bool, str]: Whether the keys were saved and the message to show to the user. On success the message contains the paths to the saved keys
+    and information about any other action taken, such as clearing keys directory on the USB drive.
+    """
+    report_progress("Generating keys...")
+    try:
+        private_key, public_key = generate_rsa_keys(bits)
+    except CryptoError as e:
+        return False, f"Key generation failed: {e}"
+    
+    report_progress("Encrypting private key...")
+    root.after(0, start_kdf_progress, estimated_kdf_seconds())
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pub_key_future = executor.submit(stage_public_key, public_key, public_key_path, key_name)
+            try:
+                private_key = encrypt_private_key(private_key, pin, report_progress)
+            except BaseException: # any failure, not only CryptoError, must not leave the staged file behind
+                if pub_key_future.exception() is None:
+                    discard_public_key(pub_key_future.result())
+                raise
+            tmp_pub_key_path = pub_key_future.result()
+    except CryptoError as e:
+        return False, f"Encryption failed: {e}"
+    except OSError as e:
+        return False, f"Key saving failed: {e}"
+    finally:
+        root.after(0, stop_kdf_progress)
+    
+    report_progress("Saving keys...")
+    try:
+        priv_key_path, pub_key_path, was_cleared = save_keys(private_key, tmp_pub_key_path, usb_path, key_name)
+    except OSError as e:
+        return False, f"Key saving failed: {e}"
+
+    cleared_info = "\n\nPrevious keys on USB drive were removed." if was_cleared else ""
+    return True, f"Encrypted private key saved to:\n{priv_key_path}\n\nPublic key saved to:\n{pub_key_path}{cleared_info}"
+
+def finish_generating(success, message):
+    """!
+    @brief Restores the GUI after the keys were generated and shows the result. Called on the Tk thread once the worker thread is done.
+
+    @param success (bool)  Whether the keys were generated and saved.
+    @param message (str)  The message returned by generate_and_save_keys().
+    """
+    progress_label.config(text="")
+    root.config(cursor="")
+    progress_label.grid_remove()
+    progress_bar.stop()
+    progress_bar.grid_remove()
+    pin_entry.config(state="normal")
+    key_name_entry.config(state="normal")
+    usb_path_entry.config(state="readonly")
+    pub_key_path_entry.config(state="normal")
+    large_key_checkbox.config(state="normal")
+    generate_button.config(state="normal")
+    refresh_button.config(state="normal")
+    browse_button.config(state="normal")
+
+    if success:
+        messagebox.showinfo("Success", message)
+    else:
+        messagebox.showerror("Error", message)
+    
+def handle_generate_button_click():
+    """! 
+    @brief Function handles the generate button click event in the GUI.
 
     @details This function retrieves user inputs from the GUI, which includes:
     - PIN to encrypt the private key
     - USB path where the private key will be saved
     - Public key save location
     - Key name for the generated keys
+    - Key size, 4096 bits if the checkbox is checked, 2048 bits otherwise
     Those inputs are validated and if error occurs, it shows a specific error message.
 
-    If the data is correct, it proceeds to generate RSA keys using the generate_rsa_keys() function from key_generation.py  file.
-    The generated keys are then encrypted using the encrypt_private_key() function from key_encryption.py file, where the PIN is used to derive the encryption key.
-    After encryption, the keys are saved using the save_keys() function from key_saving.py file, where the private key is saved on the USB device and the public key
-    is saved in the specified path.
-
-    During the process, the GUI is updated to show status messages. If any step fails, an error message is displayed, so that the user can be informed about
-    all the issues during the process.
-
-    If the keys are successfully generated, encrypted, and saved, a success message is displayed with the paths to the saved keys and information about any other
-    action taken, such as clearing keys directory on the USB drive.
+    If the data is correct, it disables GUI inputs, shows a progress messages and loading indicator, and launches generate_and_save_keys() in a new thread.
+    When the process is complete, finish_generating() restores the GUI to its original state on the Tk thread.
     """
     pin = pin_entry.get()
     usb_path = usb_path_entry.get()
     public_key_path = pub_key_path_entry.get()
     key_name = key_name_entry.get()
+    bits = 4096 if large_key_var.get() else DEFAULT_KEY_SIZE
     
     if not os.path.exists(usb_path):
         messagebox.showerror("Error", "Invalid USB path")
@@ -77,73 +249,30 @@ def generate_and_save_keys():
     if not key_name:
         messagebox.showerror("Error", "Key name cannot be empty")
         return
-    
-    progress_label.config(text="Generating keys...")
-    progress_label.update_idletasks()
-    private_key, public_key = generate_rsa_keys()
-    if private_key is None or public_key is None:
-        messagebox.showerror("Error", "Key generation failed")
-        return
-    
-    def progress_callback(message):
-        progress_label.config(text=message)
-        progress_label.update_idletasks()
-    
-    progress_label.config(text="Encrypting private key...")
-    progress_label.update_idletasks()
-    private_key = encrypt_private_key(private_key, pin, progress_callback)
-    if private_key is None:
-        messagebox.showerror("Error", "Encryption failed")
-        return
-    
-    progress_label.config(text="Saving keys...")
-    progress_label.update_idletasks()
-
-    priv_key_path, pub_key_path, was_cleared = save_keys(private_key, public_key, usb_path, public_key_path, key_name)
-    if priv_key_path is None or pub_key_path is None:
-        messagebox.showerror("Error", "Key saving failed")
-        return
-
-    progress_label.config(text="Keys saved!")
-    cleared_info = "\n\nPrevious keys on USB drive were removed." if was_cleared else ""
-    messagebox.showinfo("Success", f"Encrypted private key saved to:\n{priv_key_path}\n\nPublic key saved to:\n{pub_key_path}{cleared_info}")
 
-    
-def handle_generate_button_click():
-    """! 
-    @brief Function handles the generate button click event in the GUI.
-
-    @details Disables GUI inputs, shows a progress messages and loading indicator, and launches the key generation process in a new thread.
-    When the process is complete, it restores the GUI to its original state, enabling inputs and hiding progress messages.
-    """
     def task():
-        generate_and_save_keys()
-        progress_label.config(text="")
-        root.config(cursor="")
-        root.update()
-        progress_label.grid_remove()
-        pin_entry.config(state="normal")
-        key_name_entry.config(state="normal")
-        usb_path_entry.config(state="readonly")
-        pub_key_path_entry.config(state="normal")
-        generate_button.config(state="normal")
-        refresh_button.config(state="normal")
-        browse_button.config(state="normal")
-        progress_var.set(0)
+        try:
+            success, message = generate_and_save_keys(pin, usb_path, public_key_path, key_name, bits)
+        except Exception as e: # anything not reported by generate_and_save_keys(), the GUI must be restored in any case
+            success, message = False, f"Error: {e}"
+        root.after(0, finish_generating, success, message)
 
     root.config(cursor="wait")
-    progress_label.grid(row=6, column=0, columnspan=3, pady=5)
-    root.update()
+    progress_label.config(text="Processing...")
+    progress_label.grid(row=7, column=0, columnspan=3, pady=5)
+    progress_bar.grid(row=8, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
+    progress_bar.start(10)
 
     pin_entry.config(state="disabled")
     key_name_entry.config(state="disabled")
     usb_path_entry.config(state="disabled")
     pub_key_path_entry.config(state="disabled")
+    large_key_checkbox.config(state="disabled")
     generate_button.config(state="disabled")
     refresh_button.config(state="disabled")
     browse_button.config(state="disabled")
 
-    threading.Thread(target=task).start()
+    threading.Thread(target=task, daemon=True).start()
 
 def main_rsa():
     """!
@@ -151,12 +280,15 @@ def main_rsa():
 
     @details
     This function sets up the main window, adds labels, entry fields and buttons. All the components are arranged and configured to allow the user 
-    to enter a key name, a PIN for the private key, select a USB drive, and specify a path for saving the public key.
+    to enter a key name, a PIN for the private key, select a USB drive, specify a path for saving the public key and choose the key size.
     """
-    global root, pin_entry, key_name_entry, usb_path_entry, pub_key_path_entry
-    global progress_label, progress_var
+    global root, pin_entry, key_name_entry, usb_path_entry, pub_key_path_entry, large_key_var, large_key_checkbox
+    global progress_label, progress_bar
     global generate_button, refresh_button, browse_button
 
+    threading.Thread(target=warm_up_encryption, daemon=True).start()
+    start_key_pregeneration()
+
     root = Tk()
     root.title("RSA Key Generator")
 
@@ -184,17 +316,22 @@ def main_rsa():
     pub_key_path_entry.insert(0, default_key_path)
     browse_button.grid(row=3, column=2, padx=10, pady=5)
 
+    large_key_var = BooleanVar(value=False)
+    large_key_checkbox = Checkbutton(root, text="Use a 4096-bit key (slower to generate)", variable=large_key_var, command=update_key_size)
+    large_key_checkbox.grid(row=4, column=0, columnspan=3, padx=10, pady=5, sticky="w")
+
     root.grid_columnconfigure(1, weight=1)
 
-    progress_var = IntVar()
     progress_label = Label(root, text="Processing...")
+    progress_bar = Progressbar(root, mode="indeterminate") # switched to determinate by start_kdf_progress() while the key is derived
 
-    refresh_button = Button(root, text="Refresh USB Devices", command=update_usb_devices)
-    refresh_button.grid(row=4, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
+    refresh_button = Button(root, text="Refresh USB Devices", command=lambda: update_usb_devices(refresh=True))
+    refresh_button.grid(row=5, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
     generate_button = Button(root, text="Generate and Save Keys", command=handle_generate_button_click)
-    generate_button.grid(row=5, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
+    generate_button.grid(row=6, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
 
     root.mainloop()
+    stop_key_pregeneration()
 
 if __name__ == "__main__":
     main_rsa()
\ No newline at end of file
@@ -1,18 +1,84 @@
 """!
 @file rsa_utils.py
 @brief Utility functions for RSA application module.
+
+@details
+Used libraries:
+- 'psutil' for detecting available USB devices
+- 'pyudev' (optional, Linux only) for noticing when block devices are added or removed
+- 'time' for expiring the cached list of USB devices
 """
 
 import psutil
+import time
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
 
-def get_usb_devices():
+## How long get_usb_devices() reuses the last list of USB devices, in seconds.
+USB_CACHE_TTL = 2.0
+## Last list of USB devices and the time it was read, None when it has to be read again.
+_usb_cache = {"time": None, "devices": []}
+## pyudev observer thread invalidating _usb_cache, started on the first call to get_usb_devices().
+_usb_observer = None
+## File systems USB drives are formatted with, outside Windows other partitions are skipped before their mount options are parsed.
+USB_FSTYPES = frozenset({"vfat", "msdos", "exfat", "ntfs", "ntfs3", "fuseblk", "hfs", "apfs"})
+
+class CryptoError(Exception):
+    """!
+    @brief Raised when generating or encrypting a key fails. Caught by the GUI, which shows the message to the user.
+    """
+
+def invalidate_usb_cache(*args):
+    """!
+    @brief Forces the next call to get_usb_devices() to read the list of disks again.
+
+    @param args: Ignored, so the function can be used directly as a pyudev callback.
+    """
+    _usb_cache["time"] = None
+
+def _start_usb_observer():
+    """!
+    @brief Starts a pyudev observer that calls invalidate_usb_cache() whenever a block device is added or removed.
+
+    @details Does nothing if pyudev is not installed (for example on Windows) or the observer is already running.
+    In that case the cached list simply expires after USB_CACHE_TTL seconds.
+    """
+    global _usb_observer
+    if pyudev is None or _usb_observer is not None:
+        return
+    try:
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by(subsystem="block")
+        _usb_observer = pyudev.MonitorObserver(monitor, callback=invalidate_usb_cache, name="usb-observer")
+        _usb_observer.start()
+    except Exception as e:
+        print(f"[get_usb_devices] USB monitor unavailable: {e}")
+        _usb_observer = False
+
+def get_usb_devices(refresh=False):
     """! 
     @brief Detecting USB devices connected to the system.
 
     @details This function uses the psutil library to list all disk partitions and filters them to find removable devices (so basicly typical USB drivers).
+    Listing the disks is slow on some systems (on Windows every drive letter is queried), so the result is reused for USB_CACHE_TTL seconds.
+    On Linux with pyudev installed the cached list is also dropped as soon as a block device is added or removed.
+
+    @param refresh (bool): If True, the cached list is ignored and the disks are listed again.
 
     @return list[str]: A list of found and filtered USB device paths.
     """
-    partitions = psutil.disk_partitions()
-    usb_devices = [p.device for p in partitions if 'removable' in p.opts]
-    return usb_devices
\ No newline at end of file
+    now = time.monotonic()
+    if not refresh and _usb_cache["time"] is not None and now - _usb_cache["time"] < USB_CACHE_TTL:
+        return list(_usb_cache["devices"])
+
+    _start_usb_observer()
+    partitions = psutil.disk_partitions(all=False) # physical devices only, network shares and pseudo file systems are skipped
+    usb_devices = [p.device for p in partitions
+                   if (psutil.WINDOWS or p.fstype.lower() in USB_FSTYPES) # cheap pre-filter, on Windows the removable option alone decides
+                   and 'removable' in p.opts.split(',')] # a whole option, not a substring of one
+    _usb_cache["devices"] = usb_devices
+    _usb_cache["time"] = now
+    return list(usb_devices)
\ No newline at end of file